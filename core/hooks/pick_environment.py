@@ -12,47 +12,25 @@
 Hook which chooses an environment file to use based on the current context.
 """
 
+import os
+import sys
+
 from sgtk import Hook
 
+# Fix-up sys.path so we can access our utils
+config_root = os.path.normpath(os.path.join(os.path.dirname(__file__), os.pardir, os.pardir))
+utils_path = os.path.join(config_root, "hooks", "utils")
+if utils_path not in sys.path:
+    sys.path.append(utils_path)
+
+import environment_picker
+
 
 class PickEnvironment(Hook):
     def execute(self, context, **kwargs):
         """
-        The default implementation assumes there are three environments, called shot, asset
-        and project, and switches to these based on entity type.
+        Picks the environment based on the context source entity, entity and
+        step, as defined in core/pick_environment.yml.
         """
-        if context.source_entity:
-            if context.source_entity["type"] == "Version":
-                return "version"
-            elif context.source_entity["type"] == "PublishedFile":
-                return "publishedfile"
-
-        if context.project is None:
-            # Our context is completely empty. We're going into the site context.
-            return "site"
-
-        if context.entity is None:
-            # We have a project but not an entity.
-            return "project"
-
-        if context.entity and context.step is None:
-            # We have an entity but no step.
-            if context.entity["type"] == "Shot":
-                return "shot"
-            if context.entity["type"] == "Asset":
-                return "asset"
-            if context.entity["type"] == "Sequence":
-                return "sequence"
-            if context.entity["type"] == "Note":
-                return "shotgun_note"
-
-        if context.entity and context.step:
-            # We have a step and an entity.
-            if context.entity["type"] == "Shot":
-                return "shot_step"
-            if context.entity["type"] == "Asset":
-                return "asset_step"
-            if context.entity["type"] == "Sequence":
-                return "sequence_step"
-
-        return None
+        # The environments are defined in core/pick_environment.yml
+        return environment_picker.get_picker(config_root).pick(context)
@@ -0,0 +1,439 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+I/O Hook which creates folders on disk.
+
+Creating the folders of core/schema for a new shot or asset means hundreds of
+mkdir calls, which are slow when serialized on network storage. This hook:
+
+- computes the full set of folders up front
+- skips the folders recorded in a local manifest as already created, after
+  checking that the deepest of them still exist (which implies their parents
+  do)
+- creates the others with a bounded thread pool, parents before children
+- reports the timing
+
+There is one manifest per set of project roots, holding at most
+MANIFEST_MAX_SIZE folders: the oldest ones are dropped when it is compacted.
+
+The number of threads is set by the SHOTGUN_FOLDER_CREATION_WORKERS
+environment variable (default 8, 1 creates the folders serially). Setting
+SHOTGUN_FOLDER_CREATION_IGNORE_MANIFEST to 1 ignores the manifest.
+"""
+
+from tank import Hook
+import errno
+import hashlib
+import os
+import shutil
+import sys
+import threading
+import time
+
+DEFAULT_WORKERS = 8
+MANIFEST_FILE_NAME = "folder_creation_manifest_%s.txt"
+MANIFEST_MAX_SIZE = 20000
+
+
+class _FolderManifest(object):
+    """
+    Local record of the folders known to exist, one path per line, oldest
+    first
+    """
+
+    def __init__(self, path, max_size=MANIFEST_MAX_SIZE):
+        self._path = path
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        # Line count of the file, which may hold duplicates until compacted
+        self._line_count = 0
+        self._folders = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                for line in f:
+                    folder = line.rstrip("\n")
+                    if folder:
+                        self._line_count += 1
+                        # Keep the most recent position of each folder
+                        self._folders.pop(folder, None)
+                        self._folders[folder] = True
+
+    def __contains__(self, folder):
+        return folder in self._folders
+
+    def add(self, folders):
+        folders = [folder for folder in folders if folder not in self._folders]
+        if not folders:
+            return
+        with self._lock:
+            for folder in folders:
+                self._folders[folder] = True
+            manifest_folder = os.path.dirname(self._path)
+            if not os.path.isdir(manifest_folder):
+                os.makedirs(manifest_folder)
+            if self._line_count + len(folders) > self._max_size:
+                self._compact()
+                return
+            with open(self._path, "a") as f:
+                f.write("".join(folder + "\n" for folder in folders))
+            self._line_count += len(folders)
+
+    def discard(self, folders):
+        """
+        Forgets the passed folders, e.g. because they were removed from the
+        storage. The file is rewritten
+        """
+        folders = [folder for folder in folders if folder in self._folders]
+        if not folders:
+            return
+        with self._lock:
+            for folder in folders:
+                del self._folders[folder]
+            self._compact()
+
+    def _compact(self):
+        # Only keep the most recent folders, without duplicates
+        folders = list(self._folders)[-self._max_size:]
+        self._folders = dict((folder, True) for folder in folders)
+        temp_path = "%s.%d.tmp" % (self._path, os.getpid())
+        with open(temp_path, "w") as f:
+            f.write("".join(folder + "\n" for folder in folders))
+        if sys.platform == "win32" and os.path.exists(self._path):
+            os.remove(self._path)
+        os.rename(temp_path, self._path)
+        self._line_count = len(folders)
+
+
+def _get_manifest_path(roots):
+    """
+    Returns the path of the manifest of the passed project roots
+    """
+    from tank.util import LocalFileStorageManager
+
+    cache_root = LocalFileStorageManager.get_global_root(LocalFileStorageManager.CACHE)
+    roots_key = "\n".join(sorted(os.path.normpath(root) for root in roots))
+    roots_hash = hashlib.sha1(roots_key.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_root, "folder_creation", MANIFEST_FILE_NAME % roots_hash)
+
+
+def _get_leaf_folders(folders):
+    """
+    Returns the passed folders which are not the parent of another one
+    """
+    parents = set(os.path.dirname(folder) for folder in folders)
+    return [folder for folder in folders if folder not in parents]
+
+
+def _create_folder(path):
+    """
+    Creates a folder whose parent is expected to exist. Returns True if the
+    folder was created, False if it already existed
+    """
+    try:
+        os.mkdir(path, 0o777)
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            return False
+        if e.errno != errno.ENOENT:
+            raise
+        # The parent is missing, e.g. it was removed from the storage after
+        # being recorded in the manifest
+        try:
+            os.makedirs(path, 0o777)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            return False
+    return True
+
+
+def _map(function, values, workers):
+    if workers <= 1 or len(values) <= 1:
+        return [function(value) for value in values]
+
+    from multiprocessing.pool import ThreadPool
+
+    pool = ThreadPool(min(workers, len(values)))
+    try:
+        return pool.map(function, values)
+    finally:
+        pool.close()
+        pool.join()
+
+
+class ProcessFolderCreation(Hook):
+    def execute(self, items, preview_mode, **kwargs):
+        """
+        Creates a list of files and folders.
+
+        The default implementation creates files and folders recursively using
+        open permissions.
+
+        This hook should return a list of created items.
+
+        Items is a list of dictionaries. Each dictionary can be of the following type:
+
+        Standard Folder
+        ---------------
+        This represents a standard folder in the file system which is not associated
+        with anything in Shotgun. It contains the following keys:
+
+        * "action": "folder"
+        * "metadata": The configuration yaml data for this item
+        * "path": path on disk to the item
+
+        Entity Folder
+        -------------
+        This represents a folder in the file system which is associated with a
+        Shotgun entity. It contains the following keys:
+
+        * "action": "entity_folder"
+        * "metadata": The configuration yaml data for this item
+        * "path": path on disk to the item
+        * "entity": Shotgun entity link dict with keys type, id and name.
+
+        Remote Entity Folder
+        --------------------
+        This is the same as an entity folder, except that it was originally
+        created in another location. A remote folder request means that your
+        local toolkit instance has detected that folders have been created by
+        a different file system setup. It contains the following keys:
+
+        * "action": "remote_entity_folder"
+        * "metadata": The configuration yaml data for this item
+        * "path": path on disk to the item
+        * "entity": Shotgun entity link dict with keys type, id and name.
+
+        File Copy
+        ---------
+        This represents a file copy operation which should be carried out.
+        It contains the following keys:
+
+        * "action": "copy"
+        * "metadata": The configuration yaml data associated with the directory level
+                      on which this object exists.
+        * "source_path": location of the file that should be copied
+        * "target_path": target location to where the file should be copied.
+
+        File Creation
+        -------------
+        This is similar to the file copy, but instead of a source path, a chunk
+        of data is specified. It contains the following keys:
+
+        * "action": "create_file"
+        * "metadata": The configuration yaml data associated with the directory level
+                      on which this object exists.
+        * "content": file content
+        * "target_path": target location to where the file should be copied.
+
+        Symbolic Links
+        --------------
+        This represents a request that a symbolic link is created. Note that symbolic links are not
+        supported in the same way on all operating systems. The default hook therefore does not
+        implement symbolic link support on Windows systems. If you want to add symbolic link support
+        on windows, simply copy this hook to your project configuration and make the necessary
+        modifications.
+
+        * "action": "symlink"
+        * "metadata": The raw configuration yaml data associated with symlink yml config file.
+        * "path": the path to the symbolic link
+        * "target": the target to which the symbolic link should point
+        """
+
+        # set the umask so that we get true permissions
+        old_umask = os.umask(0)
+        try:
+            if preview_mode:
+                return self._preview(items)
+
+            start = time.time()
+            locations = self._create_folders(items)
+            folders_time = time.time() - start
+
+            locations += self._create_files(items)
+            self.logger.info(
+                "Folder creation: %d items created in %.2f s (folders: %.2f s)"
+                % (len(locations), time.time() - start, folders_time)
+            )
+        finally:
+            # reset umask
+            os.umask(old_umask)
+
+        return locations
+
+    def _create_folders(self, items):
+        """
+        Creates the folders of the passed items. Returns the created folders
+        """
+        workers = int(os.environ.get("SHOTGUN_FOLDER_CREATION_WORKERS", DEFAULT_WORKERS))
+
+        manifest = None
+        if os.environ.get("SHOTGUN_FOLDER_CREATION_IGNORE_MANIFEST") != "1":
+            try:
+                manifest = _FolderManifest(_get_manifest_path(self.parent.roots.values()))
+            except Exception as e:
+                self.logger.debug("Could not read the folder creation manifest: %s" % e)
+
+        # Compute the full set of folders up front
+        folders = set()
+        for i in items:
+            action = i.get("action")
+            if action in ["entity_folder", "folder"]:
+                folders.add(os.path.normpath(i.get("path")))
+            elif action == "create_file":
+                folders.add(os.path.normpath(os.path.dirname(i.get("path"))))
+
+        requested_count = len(folders)
+        if manifest:
+            folders = self._skip_known_folders(folders, manifest, workers)
+
+        # Create the folders level by level, so that the parents of the
+        # folders of a level exist before they are created
+        levels = {}
+        for folder in folders:
+            levels.setdefault(folder.count(os.sep), []).append(folder)
+
+        created_folders = []
+        for depth in sorted(levels):
+            level = sorted(levels[depth])
+            for (folder, created) in zip(level, _map(_create_folder, level, workers)):
+                if created:
+                    created_folders.append(folder)
+
+        if manifest:
+            try:
+                manifest.add(folders)
+            except Exception as e:
+                self.logger.debug("Could not update the folder creation manifest: %s" % e)
+
+        self.logger.debug(
+            "Folder creation: %d folders requested, %d skipped (manifest), %d created with %d workers"
+            % (requested_count, requested_count - len(folders), len(created_folders), workers)
+        )
+
+        # Only report the folders of the items, not the parents of the files
+        item_folders = set(
+            os.path.normpath(i.get("path"))
+            for i in items
+            if i.get("action") in ["entity_folder", "folder"]
+        )
+        locations = [folder for folder in created_folders if folder in item_folders]
+
+        for i in items:
+            if i.get("action") == "remote_entity_folder":
+                # Remote structure creation. For now, just register
+                # this in the return data and don't actually create the folder.
+                locations.append(i.get("path"))
+        return locations
+
+    def _skip_known_folders(self, folders, manifest, workers):
+        """
+        Returns the passed folders which are not known to exist. The folders
+        of the manifest are checked through their leaves: a missing leaf and
+        its ancestors are created again
+        """
+        known_folders = [folder for folder in folders if folder in manifest]
+        if not known_folders:
+            return list(folders)
+
+        leaves = _get_leaf_folders(known_folders)
+        missing_leaves = [
+            leaf for (leaf, exists) in zip(leaves, _map(os.path.isdir, leaves, workers)) if not exists
+        ]
+        if not missing_leaves:
+            return [folder for folder in folders if folder not in manifest]
+
+        # The ancestors of a missing folder may be missing too
+        stale_folders = set()
+        for leaf in missing_leaves:
+            folder = leaf
+            while folder in manifest and folder not in stale_folders:
+                stale_folders.add(folder)
+                folder = os.path.dirname(folder)
+        self.logger.debug(
+            "Folder creation: %d folders of the manifest are missing from the storage"
+            % len(missing_leaves)
+        )
+        try:
+            manifest.discard(stale_folders)
+        except Exception as e:
+            self.logger.debug("Could not update the folder creation manifest: %s" % e)
+        return [folder for folder in folders if folder not in manifest or folder in stale_folders]
+
+    def _create_files(self, items):
+        """
+        Creates the symbolic links, file copies and new files of the passed
+        items. Returns the created paths
+        """
+        locations = []
+        for i in items:
+            action = i.get("action")
+            if action == "symlink":
+                # symbolic link
+                if sys.platform == "win32":
+                    # no windows support
+                    continue
+                path = i.get("path")
+                target = i.get("target")
+                # note use of lexists to check existance of symlink
+                # rather than what symlink is pointing at
+                if not os.path.lexists(path):
+                    os.symlink(target, path)
+                    locations.append(path)
+
+            elif action == "copy":
+                # a file copy
+                source_path = i.get("source_path")
+                target_path = i.get("target_path")
+                if not os.path.exists(target_path):
+                    # do a standard file copy
+                    shutil.copy(source_path, target_path)
+                    # set permissions to open
+                    os.chmod(target_path, 0o666)
+                    locations.append(target_path)
+
+            elif action == "create_file":
+                # create a new file based on content
+                path = i.get("path")
+                parent_folder = os.path.dirname(path)
+                content = i.get("content")
+                if not os.path.exists(parent_folder):
+                    # the manifest may be out of date
+                    os.makedirs(parent_folder, 0o777)
+                if not os.path.exists(path):
+                    # create the file
+                    with open(path, "wb") as fp:
+                        fp.write(content)
+                    # and set permissions to open
+                    os.chmod(path, 0o666)
+                    locations.append(path)
+        return locations
+
+    def _preview(self, items):
+        """
+        Returns the paths that would be created, without creating anything
+        """
+        locations = []
+        for i in items:
+            action = i.get("action")
+            if action in ["entity_folder", "folder", "create_file"]:
+                path = i.get("path")
+                if not os.path.exists(path):
+                    locations.append(path)
+            elif action == "remote_entity_folder":
+                locations.append(i.get("path"))
+            elif action == "symlink":
+                if sys.platform != "win32" and not os.path.lexists(i.get("path")):
+                    locations.append(i.get("path"))
+            elif action == "copy":
+                if not os.path.exists(i.get("target_path")):
+                    locations.append(i.get("target_path"))
+        return locations
@@ -1,4 +1,5 @@
 import os
+import re
 import maya.cmds as cmds
 import sgtk
 
@@ -10,6 +11,34 @@ class MayaSessionCollectorExt(HookBaseClass):
     Collector that operates on the maya session. Should inherit from the basic
     collector hook.
     """
+    @property
+    def settings(self):
+        """
+        Dictionary defining the settings that this collector expects to receive
+        through the settings parameter in the process_current_session and
+        process_file methods.
+        """
+        # inherit the settings from the base collector hook
+        collector_settings = super(MayaSessionCollectorExt, self).settings or {}
+
+        # settings specific to this collector
+        maya_fbx_settings = {
+            "Split FBX Per Asset": {
+                "type": "bool",
+                "default": False,
+                "description": "Create one FBX item per top-level group and "
+                               "selection set of the session (plus one for "
+                               "the top-level geometry in none of them), "
+                               "instead of a single FBX item for the whole "
+                               "scene. The FBX files are exported "
+                               "concurrently.",
+            }
+        }
+
+        # update the base settings with these settings
+        collector_settings.update(maya_fbx_settings)
+        return collector_settings
+
     def process_current_session(self, settings, parent_item):
         """
         Analyzes the current session open in Maya and parents a subtree of
@@ -49,12 +78,6 @@ class MayaSessionCollectorExt(HookBaseClass):
             session_item.properties["work_template"] = work_template
             self.logger.debug("Work template defined for Maya collection.")
 
-        fbx_item = session_item.create_item(
-            "maya.fbx",
-            "Asset - FBX Export",
-            "Asset FBX"
-        )
-
         icon_path = os.path.join(
             self.disk_location,
             os.pardir,
@@ -62,4 +85,152 @@ class MayaSessionCollectorExt(HookBaseClass):
             "fbx.png"
         )
 
-        fbx_item.set_icon_from_path(icon_path)
\ No newline at end of file
+        split_setting = settings.get("Split FBX Per Asset")
+        assets = []
+        if split_setting and split_setting.value:
+            assets = _collect_fbx_assets(self.logger)
+            self.logger.debug("Found {} assets to export as FBX.".format(len(assets)))
+
+        if not assets:
+            fbx_item = session_item.create_item(
+                "maya.fbx",
+                "Asset - FBX Export",
+                "Asset FBX"
+            )
+            fbx_item.set_icon_from_path(icon_path)
+            return
+
+        for (asset_name, nodes) in assets:
+            fbx_item = session_item.create_item(
+                "maya.fbx",
+                "Asset - FBX Export",
+                "Asset FBX ({})".format(asset_name)
+            )
+            # used by the FBX publish plugin to resolve the publish template
+            # and to only export these nodes
+            fbx_item.properties["fbx_asset_name"] = asset_name
+            fbx_item.properties["fbx_export_nodes"] = nodes
+            fbx_item.set_icon_from_path(icon_path)
+
+# Name of the asset holding the top-level geometry which belongs to no other
+# asset
+LOOSE_ASSET_NAME = "Loose"
+
+
+def _get_isolate_select_sets():
+    """
+    Returns the sets used by the viewports to isolate the selection (e.g.
+    modelPanel4ViewSelectedSet)
+    """
+    isolate_sets = set()
+    try:
+        for panel in cmds.getPanel(type="modelPanel") or []:
+            isolate_set = cmds.isolateSelect(panel, query=True, viewObjects=True)
+            if isolate_set:
+                isolate_sets.add(isolate_set)
+    except RuntimeError:
+        # No UI, e.g. in batch mode
+        pass
+    return isolate_sets
+
+
+def _is_under(node, parent):
+    """
+    Returns True if the passed long node name is parent or one of its
+    descendants
+    """
+    return node == parent or node.startswith(parent + "|")
+
+
+def _collect_fbx_assets(logger=None):
+    """
+    Returns (asset name, nodes) for each top-level group and selection set of
+    the session, plus one for the top-level geometry which belongs to none of
+    them. A node is only exported once: the sets whose members all sit under
+    a top-level group, and the groups which are members of a set, are
+    skipped. Asset names are unique and only contain letters and digits, so
+    that they can be used in paths
+    """
+    # Top-level groups: transforms without shapes of their own (which
+    # excludes the cameras and the lights)
+    groups = []
+    loose_nodes = []
+    for node in cmds.ls(assemblies=True, long=True) or []:
+        if cmds.nodeType(node) != "transform":
+            continue
+        shapes = cmds.listRelatives(node, shapes=True, fullPath=True)
+        if shapes:
+            if not cmds.ls(shapes, type=["camera", "light"]):
+                loose_nodes.append(node)
+            continue
+        if not cmds.listRelatives(node, children=True, type="transform"):
+            continue
+        groups.append(node)
+
+    # Selection sets: plain object sets which are neither default sets,
+    # deformer sets, isolate select sets nor sets of referenced files
+    default_nodes = set(cmds.ls(defaultNodes=True) or [])
+    excluded_sets = _get_isolate_select_sets()
+    sets = []
+    for node in cmds.ls(exactType="objectSet") or []:
+        if node in default_nodes or node in excluded_sets or re.search(r"ViewSelectedSet\d*$", node):
+            continue
+        if cmds.referenceQuery(node, isNodeReferenced=True):
+            continue
+        members = cmds.sets(node, query=True)
+        if not members:
+            continue
+        if cmds.listConnections(node, type="geometryFilter"):
+            continue
+        members = cmds.ls(members, long=True, objectsOnly=True) or []
+        if members:
+            sets.append((node, members))
+
+    # The sets whose members are all exported with a top-level group would
+    # export the same geometry twice
+    kept_sets = []
+    for (node, members) in sets:
+        if all(any(_is_under(member, group) for group in groups) for member in members):
+            if logger:
+                logger.info("The '{}' set is not exported as an asset: its members are exported "
+                            "with their top-level group".format(node))
+            continue
+        kept_sets.append((node, members))
+
+    # The groups which are members of a set are exported with the set
+    set_members = set()
+    for (node, members) in kept_sets:
+        set_members.update(members)
+    kept_groups = []
+    for group in groups:
+        if group in set_members:
+            if logger:
+                logger.info("The '{}' group is not exported as an asset: it is exported with a "
+                            "set it belongs to".format(group))
+            continue
+        kept_groups.append(group)
+
+    assets = [(group, [group]) for group in kept_groups]
+    assets += [(node, [node]) for (node, members) in kept_sets]
+
+    # The top-level geometry which is not in any set would not be exported
+    loose_nodes = [node for node in loose_nodes if not any(
+        _is_under(member, node) for member in set_members)]
+    if loose_nodes and assets:
+        if logger:
+            logger.warning("{} top-level node(s) belong to no group or set, they are exported "
+                           "as the '{}' asset: {}".format(len(loose_nodes), LOOSE_ASSET_NAME, ", ".join(loose_nodes)))
+        assets.append((LOOSE_ASSET_NAME, loose_nodes))
+
+    unique_assets = []
+    asset_names = set()
+    for (node, nodes) in assets:
+        base_name = re.sub(r"[^A-Za-z0-9]", "", node.split("|")[-1].split(":")[-1]) or "asset"
+        asset_name = base_name
+        index = 1
+        while asset_name.lower() in asset_names:
+            index += 1
+            asset_name = "{}{}".format(base_name, index)
+        asset_names.add(asset_name.lower())
+        unique_assets.append((asset_name, nodes))
+    return unique_assets
@@ -1,11 +1,33 @@
 ﻿import os
+import sys
 import maya.cmds as cmds
 import maya.mel as mel
 import sgtk
 from sgtk.util.filesystem import ensure_folder_exists
 
+# Fix-up sys.path so we can access our utils
+utils_path = os.path.split(__file__)[0]
+utils_path = os.path.join(utils_path, os.pardir, os.pardir, os.pardir, 'utils')
+utils_path = os.path.normpath(utils_path)
+if utils_path not in sys.path:
+    sys.path.append(utils_path)
+
+import maya_fbx_export
+import template_index
+import unity_metadata
+
 HookBaseClass = sgtk.get_hook_baseclass()
 
+# Text field of PublishedFile entities storing the content hash of the
+# exported scene, used to skip exporting unchanged scenes again
+CONTENT_HASH_FIELD = "sg_content_hash"
+
+# Fields of PublishedFile entities storing the sha1 (text) and the size in
+# bytes (number or text) of the FBX, so that it can be verified or
+# deduplicated downstream without reading it again
+CHECKSUM_FIELD = "sg_checksum"
+FILE_SIZE_FIELD = "sg_file_size"
+
 
 class MayaSessionFBXPublishPlugin(HookBaseClass):
     """
@@ -49,6 +71,23 @@ class MayaSessionFBXPublishPlugin(HookBaseClass):
                 "description": "Template path for published work files. Should"
                                "correspond to a template defined in "
                                "templates.yml.",
+            },
+            "FBX Asset Publish Template": {
+                "type": "template",
+                "default": None,
+                "description": "Template path for the FBX files of the assets "
+                               "of the session, when the collector creates "
+                               "one item per asset. Should have a fbx_asset "
+                               "key.",
+            },
+            "Export In Background": {
+                "type": "bool",
+                "default": False,
+                "description": "Export the saved scene from a headless mayapy "
+                               "process instead of the Maya session. The FBX "
+                               "is registered once the export succeeded, "
+                               "during finalize. Per-asset FBX files are "
+                               "always exported in the background.",
             }
         }
 
@@ -62,10 +101,14 @@ class MayaSessionFBXPublishPlugin(HookBaseClass):
         return ["maya.fbx"]
 
     def accept(self, settings, item):
-        template_name_setting = settings.get("FBX Publish Template")
+        # Per-asset items have their own template
+        template_setting_name = "FBX Publish Template"
+        if item.properties.get("fbx_asset_name"):
+            template_setting_name = "FBX Asset Publish Template"
+        template_name_setting = settings.get(template_setting_name)
         
-        if not template_name_setting:
-            self.logger.debug('Missing "FBX Publish Template" setting.Not accepting the item.')
+        if not template_name_setting or not template_name_setting.value:
+            self.logger.debug('Missing "{}" setting.Not accepting the item.'.format(template_setting_name))
             return { "accepted": False }
             
         publisher = self.parent
@@ -73,7 +116,7 @@ class MayaSessionFBXPublishPlugin(HookBaseClass):
         template_name = template_name_setting.value
         publish_template = publisher.get_template_by_name(template_name)
         if not publish_template:
-            self.logger.debug('Could not find a template matching the FBX Publish Template setting ({})'.format(template_name))
+            self.logger.debug('Could not find a template matching the {} setting ({})'.format(template_setting_name, template_name))
             return { "accepted": False }
         
         # If a publish template is configured, disable context change. This
@@ -111,8 +154,15 @@ class MayaSessionFBXPublishPlugin(HookBaseClass):
         # Get the normalized path
         path = sgtk.util.ShotgunPath.normalize(path)
 
-        # Get the configured work file template
+        # Get the configured work file template, or the template matching
+        # the session path
         work_template = item.parent.properties.get("work_template")
+        if not work_template:
+            try:
+                work_template = template_index.template_from_path(self.parent.sgtk, path)
+            except sgtk.TankError as e:
+                self.logger.error("Could not resolve the work template of '{}': {}".format(path, e))
+                return False
         if not work_template:
             self.logger.error('Missing "Work Template" setting in the collector')
             return False
@@ -122,6 +172,8 @@ class MayaSessionFBXPublishPlugin(HookBaseClass):
         # Get the current scene path and extract fields from it using the work
         # template:
         work_fields = work_template.get_fields(path)
+        if item.properties.get("fbx_asset_name"):
+            work_fields["fbx_asset"] = item.properties["fbx_asset_name"]
 
         # Ensure the fields work for the publish template
         missing_keys = publish_template.missing_keys(work_fields)
@@ -139,6 +191,13 @@ class MayaSessionFBXPublishPlugin(HookBaseClass):
         if "version" in work_fields:
             item.properties["publish_version"] = work_fields["version"]
 
+        if _export_in_background(settings, item):
+            if not maya_fbx_export.get_mayapy_path():
+                self.logger.error('Could not find mayapy, required to export the FBX in the background.')
+                return False
+            if cmds.file(query=True, modified=True):
+                self.logger.warning('The FBX is exported from the saved scene: unsaved changes will not be exported.')
+
         # run the base class validation
         return super(MayaSessionFBXPublishPlugin, self).validate(settings, item)
 
@@ -152,6 +211,27 @@ class MayaSessionFBXPublishPlugin(HookBaseClass):
         publish_folder = os.path.dirname(publish_path)
         self.parent.ensure_folder_exists(publish_folder)
 
+        # Reuse the FBX of a previous publish of the same content if there is
+        # one
+        item.properties["fbx_content_hash"] = self._get_content_hash(settings, item)
+        if self._reuse_existing_fbx(item, publish_path):
+            self._register_publish(settings, item)
+            return
+
+        if _export_in_background(settings, item):
+            # The base publish is registered in finalize, once the export
+            # succeeded. The exports of all the items run concurrently in the
+            # pool
+            export_process = maya_fbx_export.FBXExportProcess(
+                cmds.file(query=True, sn=True), publish_path, nodes=item.properties.get("fbx_export_nodes"))
+            maya_fbx_export.get_export_pool().submit(export_process)
+            if export_process.error:
+                self.logger.error(export_process.error)
+                return
+            item.properties["fbx_export_process"] = export_process
+            self.logger.info("Exporting the FBX in the background: {}".format(publish_path))
+            return
+
         # Execute it:
         try:
             self.parent.log_debug("Exporting Maya scene as FBX: {}".format(publish_path))
@@ -160,10 +240,227 @@ class MayaSessionFBXPublishPlugin(HookBaseClass):
             self.logger.error("Failed to export FBX: {}".format(e))
             return
 
+        # Right after the export, the FBX is still in the page cache
+        (item.properties["fbx_checksum"], item.properties["fbx_size"]) = maya_fbx_export.compute_checksum(publish_path)
+
         # Now that the path has been generated, hand it off to the
         # parent hook
+        self._register_publish(settings, item)
+
+    def finalize(self, settings, item):
+        export_process = item.properties.get("fbx_export_process")
+        if export_process:
+            item.properties["fbx_export_process"] = None
+            if not self._wait_for_export(export_process, item):
+                return
+
+            # Now that the FBX has been exported, hand it off to the parent
+            # hook
+            self._register_publish(settings, item)
+
+        super(MayaSessionFBXPublishPlugin, self).finalize(settings, item)
+
+    def get_publish_name(self, settings, item):
+        publish_name = super(MayaSessionFBXPublishPlugin, self).get_publish_name(settings, item)
+
+        # Tell the FBX files of the assets of the session apart
+        asset_name = item.properties.get("fbx_asset_name")
+        if asset_name:
+            (base_name, extension) = os.path.splitext(publish_name)
+            publish_name = "{}_{}{}".format(base_name, asset_name, extension)
+        return publish_name
+
+    def _register_publish(self, settings, item):
+        """
+        Registers the publish with the base publish plugin, along with the
+        content hash of the exported scene and the checksum and size of the
+        FBX
+        """
         super(MayaSessionFBXPublishPlugin, self).publish(settings, item)
 
+        publish_data = item.properties.get("sg_publish_data")
+        if not publish_data:
+            return
+
+        fields = {}
+        if item.properties.get("fbx_content_hash"):
+            fields[CONTENT_HASH_FIELD] = item.properties["fbx_content_hash"]
+
+        schema = unity_metadata.get_entity_schema("PublishedFile", self.parent.shotgun)
+        checksum_type = schema.get(CHECKSUM_FIELD, {}).get("data_type", {}).get("value", "")
+        size_type = schema.get(FILE_SIZE_FIELD, {}).get("data_type", {}).get("value", "")
+        if item.properties.get("fbx_checksum") and checksum_type == "text":
+            fields[CHECKSUM_FIELD] = item.properties["fbx_checksum"]
+        if item.properties.get("fbx_size") is not None and size_type in ["number", "text"]:
+            size = item.properties["fbx_size"]
+            fields[FILE_SIZE_FIELD] = size if size_type == "number" else str(size)
+        if checksum_type != "text" or size_type not in ["number", "text"]:
+            self.logger.debug("Create a text field '{}' and a number field '{}' on PublishedFile entity type "
+                              "to store the checksum and size of the FBX".format(CHECKSUM_FIELD, FILE_SIZE_FIELD))
+
+        if fields:
+            self.parent.shotgun.update("PublishedFile", publish_data["id"], fields)
+
+    def _get_content_hash(self, settings, item):
+        """
+        Returns the content hash of the exported content, or None if it
+        cannot be stored or does not describe the exported content
+        """
+        if not _export_in_background(settings, item) and cmds.file(query=True, modified=True):
+            # The hash is computed from the files on disk, while the session
+            # is exported with its unsaved changes
+            return None
+
+        fields = unity_metadata.get_entity_schema("PublishedFile", self.parent.shotgun)
+        if not fields.get(CONTENT_HASH_FIELD) or fields[CONTENT_HASH_FIELD].get("data_type", {}).get("value", "") != "text":
+            self.logger.debug("There is no text field '{}' on PublishedFile entity type. Create one to skip "
+                              "exporting unchanged scenes again".format(CONTENT_HASH_FIELD))
+            return None
+
+        exporter_version = cmds.pluginInfo("fbxmaya", query=True, version=True)
+
+        nodes = item.properties.get("fbx_export_nodes")
+        if nodes:
+            # Only depend on the content of the asset when possible, so that
+            # the FBX files of the unchanged assets are reused
+            asset_content = _get_asset_content(nodes)
+            if asset_content:
+                (paths, extra_data) = asset_content
+                return maya_fbx_export.compute_content_hash(paths, maya_fbx_export.DEFAULT_OPTIONS,
+                                                            exporter_version, extra_data)
+
+        paths = [cmds.file(query=True, sn=True)] + _reference_paths()
+        return maya_fbx_export.compute_content_hash(paths, maya_fbx_export.DEFAULT_OPTIONS, exporter_version,
+                                                    "\n".join(nodes or []))
+
+    def _reuse_existing_fbx(self, item, publish_path):
+        """
+        Links the FBX of a previous publish with the same content hash and
+        publish template to the publish path. Returns True if there was one
+        """
+        content_hash = item.properties.get("fbx_content_hash")
+        if not content_hash:
+            return False
+
+        publish_template = item.properties["publish_template"]
+        schema = unity_metadata.get_entity_schema("PublishedFile", self.parent.shotgun)
+        publishes = self.parent.shotgun.find(
+            "PublishedFile",
+            [["project", "is", item.context.project], [CONTENT_HASH_FIELD, "is", content_hash]],
+            ["path"] + [field for field in [CHECKSUM_FIELD, FILE_SIZE_FIELD] if field in schema],
+            order=[{ "field_name": "created_at", "direction": "desc" }]
+        )
+        for publish in publishes:
+            path = (publish.get("path") or {}).get("local_path")
+            if not path or not publish_template.validate(path) or not os.path.isfile(path):
+                continue
+
+            self.logger.info("The scene has not changed since {} was exported, reusing it".format(path))
+            if os.path.normcase(os.path.abspath(path)) != os.path.normcase(os.path.abspath(publish_path)):
+                maya_fbx_export.link_or_copy(path, publish_path)
+
+            # The linked FBX has the checksum and size of the previous
+            # publish, read the file only if they were not stored
+            checksum = publish.get(CHECKSUM_FIELD)
+            size = publish.get(FILE_SIZE_FIELD)
+            if checksum and size is not None:
+                (item.properties["fbx_checksum"], item.properties["fbx_size"]) = (checksum, int(size))
+            else:
+                (item.properties["fbx_checksum"], item.properties["fbx_size"]) = maya_fbx_export.compute_checksum(publish_path)
+            return True
+        return False
+
+    def _wait_for_export(self, export_process, item):
+        """
+        Waits for the passed background export, relaying its messages to the
+        publish log. Stores the checksum and size of the FBX on the item.
+        Returns True if the export succeeded
+        """
+        from sgtk.platform.qt import QtCore
+
+        def on_message(message):
+            if message.get("type") == "progress":
+                self.logger.info("FBX export: {}".format(message.get("message")))
+            elif message.get("type") == "output":
+                self.logger.debug("mayapy: {}".format(message.get("message")))
+
+        # Keep the publisher UI responsive while waiting
+        succeeded = export_process.wait(on_message, QtCore.QCoreApplication.processEvents)
+        if not succeeded:
+            self.logger.error("Failed to export FBX: {}".format(export_process.error))
+            return False
+
+        self.logger.info("Exported {} in {:.1f} s".format(export_process.fbx_path, export_process.duration))
+        item.properties["fbx_checksum"] = export_process.checksum
+        item.properties["fbx_size"] = export_process.size
+        return True
+
+def _export_in_background(settings, item):
+    if item.properties.get("fbx_export_nodes"):
+        return True
+    setting = settings.get("Export In Background")
+    return bool(setting and setting.value)
+
+def _get_asset_content(nodes):
+    """
+    Returns (referenced file paths, description of the scene data) for the
+    passed asset nodes, when they are made of referenced nodes and plain
+    transforms (e.g. a set dressing group). Returns None if some of the
+    asset content is only stored in the scene file
+    """
+    members = []
+    for node in nodes:
+        if cmds.objectType(node, isAType="objectSet"):
+            members += cmds.sets(node, query=True) or []
+        else:
+            members.append(node)
+    members = cmds.ls(members, long=True) or []
+    members += cmds.listRelatives(members, allDescendents=True, fullPath=True) or []
+
+    reference_nodes = set()
+    data = sorted(nodes)
+    for node in sorted(set(members)):
+        if cmds.referenceQuery(node, isNodeReferenced=True):
+            reference_nodes.add(cmds.referenceQuery(node, referenceNode=True, topReference=True))
+        elif cmds.nodeType(node) == "transform":
+            data.append("{} {} {}".format(node, cmds.xform(node, query=True, matrix=True, objectSpace=True),
+                                          cmds.getAttr(node + ".visibility")))
+        else:
+            # e.g. geometry created in the scene
+            return None
+
+    # The referenced files, the references they contain, and the reference
+    # edits stored in the scene
+    paths = []
+    reference_nodes = sorted(reference_nodes)
+    while reference_nodes:
+        reference_node = reference_nodes.pop(0)
+        path = cmds.referenceQuery(reference_node, filename=True, withoutCopyNumber=True)
+        if not os.path.isfile(path):
+            return None
+        paths.append(path)
+        data += cmds.referenceQuery(reference_node, editStrings=True) or []
+        reference_nodes += cmds.referenceQuery(reference_node, referenceNode=True, child=True) or []
+
+    return (paths, "\n".join(data))
+
+def _reference_paths():
+    """
+    Returns the sorted paths of the files referenced by the current session
+    """
+    paths = set()
+    for node in cmds.ls(type="reference") or []:
+        if node.endswith("sharedReferenceNode"):
+            continue
+        try:
+            path = cmds.referenceQuery(node, filename=True, withoutCopyNumber=True)
+        except RuntimeError:
+            # Reference node without a file
+            continue
+        if os.path.isfile(path):
+            paths.add(path)
+    return sorted(paths)
+
 def _session_path():
     """
     Return the path to the current session
@@ -4,20 +4,128 @@ App Launch Hook
 This hook is executed to launch the applications.
 """
 
+import json
 import os
 import re
+import shlex
+import subprocess
 import sys
+import time
 import tank
 
+# Fix-up sys.path so we can access our utils
+utils_path = os.path.split(__file__)[0]
+utils_path = os.path.join(utils_path, os.pardir, 'utils')
+utils_path = os.path.normpath(utils_path)
+if utils_path not in sys.path:
+    sys.path.append(utils_path)
+
+import launch_trace
+import unity_editors
+import unity_metadata
+
+log = tank.LogManager.get_logger(__name__)
+
+# Processes launched by this hook. They are polled on each launch so that
+# the ones that exited do not linger as zombies
+_launched_processes = []
+
+def _split_args(args):
+    """
+    Splits a command line string into a list of arguments
+    """
+    if not args:
+        return []
+
+    if sys.platform == "win32":
+        # Backslashes are path separators on Windows, not escape characters
+        return [arg[1:-1] if len(arg) > 1 and arg[0] == arg[-1] == '"' else arg
+                for arg in shlex.split(args, posix=False)]
+    return shlex.split(args)
+
+def _quote(arg):
+    """
+    Quotes an argument for display in a POSIX shell command line
+    """
+    if hasattr(shlex, "quote"):
+        return shlex.quote(arg)
+    import pipes
+    return pipes.quote(arg)
+
+def _get_extra_args():
+    """
+    Returns the extra arguments set by the before app launch hook in the
+    SHOTGUN_EXTRA_ARGS environment variable, as a list. The variable holds a
+    json list of arguments, or a command line string
+    """
+    extra_args = os.environ.get('SHOTGUN_EXTRA_ARGS')
+    if not extra_args:
+        return []
+
+    try:
+        parsed_args = json.loads(extra_args)
+        if isinstance(parsed_args, list):
+            return [str(arg) for arg in parsed_args]
+    except ValueError:
+        pass
+    return _split_args(extra_args)
+
+def _get_project_path(args):
+    """
+    Returns the value of the -projectPath argument, if any
+    """
+    for (index, arg) in enumerate(args[:-1]):
+        if arg.lower() == '-projectpath':
+            return args[index + 1]
+    return None
+
+def _deliver_to_running_editor():
+    """
+    Hands the launch context to the running editor found by the before app
+    launch hook, if any. Returns a description of what was done, or None if
+    the application still needs to be launched
+    """
+    running_editor = os.environ.get(unity_editors.RUNNING_EDITOR_ENV_VAR)
+    if not running_editor:
+        return None
+    running_editor = json.loads(running_editor)
+
+    if running_editor.get('status') == 'starting':
+        # Starting a second editor on the same project would fail
+        log.warning('A Unity editor is already starting for this project (pid {}), not launching another one.'.format(running_editor.get('pid')))
+        return 'Unity editor already starting (pid {})'.format(running_editor.get('pid'))
+
+    launch_context = None
+    launch_context_path = os.environ.get(unity_metadata.LAUNCH_CONTEXT_ENV_VAR)
+    if launch_context_path:
+        try:
+            with open(launch_context_path) as f:
+                launch_context = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            log.debug('Could not read the launch context file "{}": {}'.format(launch_context_path, e))
+    if not launch_context:
+        return None
+
+    if not unity_editors.send_launch_request(running_editor, launch_context):
+        return None
+    # The running editor was its only consumer
+    unity_metadata.remove_launch_context()
+    return 'Launch request delivered to the running Unity editor (port {})'.format(running_editor.get('port'))
+
+def _reap_launched_processes():
+    for process in list(_launched_processes):
+        if process.poll() is not None:
+            _launched_processes.remove(process)
+
 class AppLaunch(tank.Hook):
     """
     Hook to run an application.
     """
-    
+
     def execute(self, app_path, app_args, version, engine_name, **kwargs):
         """
         The execute functon of the hook will be called to start the required application
-        
+
         :param app_path: (str) The path of the application executable
         :param app_args: (str) Any arguments the application may require
         :param version: (str) version of the application being run if set in the
@@ -26,18 +134,29 @@ class AppLaunch(tank.Hook):
             software about to be launched.
 
         :returns: (dict) The two valid keys are 'command' (str) and 'return_code' (int).
+            The 'pid' (int) and 'start_time' (float) of the launched process
+            are also returned.
         """
-        
-        extra_args = os.environ.get('SHOTGUN_EXTRA_ARGS')
-        if extra_args:
-            app_args += extra_args
-        
+        if engine_name == 'tk-unity':
+            with launch_trace.span('deliver_to_running_editor'):
+                delivered = _deliver_to_running_editor()
+            if delivered:
+                return {
+                    "command": delivered,
+                    "return_code": 0
+                }
+
+        args = _split_args(app_args) + _get_extra_args()
+
         system = sys.platform
+        popen_kwargs = {}
+
+        if system.startswith("linux"):
+            # on linux, we just run the executable directly, detached from
+            # our process group
+            cmd = [app_path] + args
+            popen_kwargs["preexec_fn"] = os.setsid
 
-        if system == "linux2":
-            # on linux, we just run the executable directly
-            cmd = "%s %s &" % (app_path, app_args)
-            
         elif system == "darwin":
             # If we're on OS X, then we have two possibilities: we can be asked
             # to launch an application bundle using the "open" command, or we
@@ -47,25 +166,60 @@ class AppLaunch(tank.Hook):
             # being asked to launch; if it's a .app, we use the "open" command,
             # and if it's not then we treat it like a typical, Unix executable.
             if app_path.endswith(".app"):
-                # The -n flag tells the OS to launch a new instance even if one is 
+                # The -n flag tells the OS to launch a new instance even if one is
                 # already running. The -a flag specifies that the path is an
                 # application and supports both the app bundle form or the full
                 # executable form.
-                cmd = "open -n -a \"%s\"" % (app_path)
-                if app_args:
-                    cmd += " --args \"%s\"" % app_args.replace("\"", "\\\"")
+                cmd = ["open", "-n", "-a", app_path]
+                if args:
+                    cmd += ["--args"] + args
             else:
-                cmd = "%s %s &" % (app_path, app_args)
-        
+                cmd = [app_path] + args
+                popen_kwargs["preexec_fn"] = os.setsid
+
         elif system == "win32":
-            # on windows, we run the start command in order to avoid
-            # any command shells popping up as part of the application launch.
-            cmd = "start /B \"App\" \"%s\" %s" % (app_path, app_args)
+            # on windows, detach the process in order to avoid any command
+            # shells popping up as part of the application launch.
+            cmd = [app_path] + args
+            popen_kwargs["creationflags"] = 0x00000008 | 0x00000200 # DETACHED_PROCESS | CREATE_NEW_PROCESS_GROUP
+
+        else:
+            cmd = [app_path] + args
+
+        if system == "win32":
+            command = subprocess.list2cmdline(cmd)
+        else:
+            command = " ".join(_quote(arg) for arg in cmd)
+
+        # run the command to launch the app. Popen returns as soon as the
+        # process is started
+        _reap_launched_processes()
+        with launch_trace.span('app_launch', engine_name=engine_name):
+            start_time = time.time()
+            try:
+                process = subprocess.Popen(cmd, close_fds=True, **popen_kwargs)
+            except (OSError, ValueError) as e:
+                log.error('Could not launch "{}": {}'.format(command, e))
+                return {
+                    "command": command,
+                    "return_code": 1
+                }
+
+        _launched_processes.append(process)
 
-        # run the command to launch the app
-        exit_code = os.system(cmd)
+        # Remember which project the editor was launched for, so that the
+        # next launches on that project can find it
+        project_path = _get_project_path(args)
+        if engine_name == 'tk-unity' and project_path:
+            try:
+                unity_editors.register_launched_editor(project_path, process.pid)
+            except Exception as e:
+                log.debug('Could not register the launched Unity editor: {}'.format(e))
+        log.debug('Launched "{}" (pid {})'.format(command, process.pid))
 
         return {
-            "command": cmd,
-            "return_code": exit_code
-        }
\ No newline at end of file
+            "command": command,
+            "return_code": 0,
+            "pid": process.pid,
+            "start_time": start_time
+        }
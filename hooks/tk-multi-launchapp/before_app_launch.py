@@ -7,6 +7,7 @@ to set environment variables or run scripts as part of the app initialization.
 import tank
 import sgtk
 
+import json
 import os
 import sys
 
@@ -17,6 +18,8 @@ utils_path = os.path.normpath(utils_path)
 if utils_path not in sys.path:
     sys.path.append(utils_path)
 
+import launch_trace
+import unity_editors
 import unity_metadata
 
 log = sgtk.LogManager.get_logger(__name__)
@@ -38,59 +41,114 @@ class BeforeAppLaunch(tank.Hook):
 
         """
         if engine_name == 'tk-unity':
-            """
-            Try to retrieve the Unity project path from SG metadata
-            """
-            multi_launchapp = self.parent
-            context = multi_launchapp.context
-            entity = context.entity
-            
-            if not entity:
-                return
-
-            sgtk = context.sgtk
-            sg = sgtk.shotgun
-
-            # Retrieve the metadata for the context entity. The Unity project
-            # of interest might be in there
-            metadata = unity_metadata.get_metadata_from_entity(entity, sg)
-            if metadata:
-                project_path = metadata.get('project_path')
-                if project_path:
-                    # Validate that the project exists on disk
-                    if os.path.exists(project_path):
-                        # Save our extra args in an environment variable as 
-                        # modifying app_args will not work (it is passed by copy)
-                        os.environ['SHOTGUN_EXTRA_ARGS'] = ' -projectPath "{}"'.format(project_path)
-                    else:
-                        log.warning('Ignoring invalid project path associated with the entity: "{}"'.format(project_path))
-
-            # Save the entity we launched from in case we switch the context
-            # entity below
-            os.environ['SHOTGUN_LAUNCH_ENTITY_TYPE'] = entity['type']
-            os.environ['SHOTGUN_LAUNCH_ENTITY_ID'] = str(entity['id'])
-
-            # Toolkit does not really support launching from a Version or a Note
-            # entity. We need to switch the context back to the supported entity
-            # (or task) for which the Version/Note was created. This is similar 
-            # to what toolkit does when launching from a published file entity.
-            entity_type = entity['type']
-            if entity_type in ['Note', 'Version']:
-                version = entity if entity_type == 'Version' else unity_metadata.get_version_from_note(entity,sg)
-
-                if version:
-                    # Fetch the Link ('entity') and Task ('sg_task') fields 
-                    found_version = sg.find_one(version['type'], [['id', 'is', version['id']]], ['entity', 'sg_task'])
-                    linked_entity = found_version.get('entity')
-
-                    if linked_entity:
-                        linked_task = found_version.get('sg_task')
-                        if linked_task:
-                            # Work in the context of the task
-                            linked_entity = linked_task
-
-                        os.environ['SHOTGUN_ENTITY_TYPE'] = linked_entity['type']
-                        os.environ['SHOTGUN_ENTITY_ID']   = str(linked_entity['id'])
+            # Each launch gets its own ID, inherited by the launched process,
+            # to correlate the trace spans of the launch
+            launch_trace.start_launch()
+            with launch_trace.span('before_app_launch'):
+                self._prepare_unity_launch()
+
+    def _prepare_unity_launch(self):
+        """
+        Try to retrieve the Unity project path from SG metadata
+        """
+        multi_launchapp = self.parent
+        context = multi_launchapp.context
+        entity = context.entity
+        
+        # Do not hand over the extra args and launch context of a previous
+        # launch
+        os.environ.pop('SHOTGUN_EXTRA_ARGS', None)
+        os.environ.pop(unity_metadata.LAUNCH_CONTEXT_ENV_VAR, None)
+        os.environ.pop(unity_editors.RUNNING_EDITOR_ENV_VAR, None)
+        unity_metadata.remove_stale_launch_contexts()
+        
+        if not entity:
+            return
+
+        sgtk = context.sgtk
+        sg = launch_trace.traced_shotgun(sgtk.shotgun)
+
+        # Retrieve the metadata for the context entity. The Unity project
+        # of interest might be in there. The entity to switch the context to
+        # is cached along with it
+        metadata = None
+        context_entity = None
+        resolved = False
+        with launch_trace.span('resolve_metadata'):
+            try:
+                (metadata, context_entity) = unity_metadata.get_cached_launch_metadata(entity, sg, self._get_context_entity)
+                resolved = True
+            except Exception as e:
+                # e.g. the site cannot be reached and nothing is cached
+                log.warning('Could not retrieve the Unity metadata of {} {}: {}'.format(entity['type'], entity['id'], e))
+        if metadata:
+            project_path = metadata.get('project_path')
+            if project_path:
+                # Validate that the project exists on disk
+                if os.path.exists(project_path):
+                    # Save our extra args in an environment variable as 
+                    # modifying app_args will not work (it is passed by copy).
+                    # They are stored as a json list so that app_launch.py 
+                    # does not need to parse quoted strings
+                    os.environ['SHOTGUN_EXTRA_ARGS'] = json.dumps(['-projectPath', project_path])
+                    
+                    # If the project is already open, app_launch.py hands 
+                    # the launch request to that editor instead of starting
+                    # a new one
+                    with launch_trace.span('find_running_editor'):
+                        running_editor = unity_editors.find_running_editor(project_path)
+                    if running_editor:
+                        os.environ[unity_editors.RUNNING_EDITOR_ENV_VAR] = json.dumps(running_editor)
                 else:
-                    log.warning('Could not find a Version entity linked to the Note ({}). Some toolkit features might not be available.'.format(entity))
-                
+                    log.warning('Ignoring invalid project path associated with the entity: "{}"'.format(project_path))
+
+        # Save the entity we launched from in case we switch the context
+        # entity below
+        os.environ['SHOTGUN_LAUNCH_ENTITY_TYPE'] = entity['type']
+        os.environ['SHOTGUN_LAUNCH_ENTITY_ID'] = str(entity['id'])
+
+        if context_entity:
+            os.environ['SHOTGUN_ENTITY_TYPE'] = context_entity['type']
+            os.environ['SHOTGUN_ENTITY_ID']   = str(context_entity['id'])
+
+        # Hand the resolved metadata over to tk-unity so that it does not 
+        # need to query Shotgun again (see apply_metadata.py). When the 
+        # lookup failed, there is no launch context file: tk-unity queries 
+        # Shotgun itself, once the site can be reached
+        if not resolved:
+            return
+        try:
+            with launch_trace.span('write_launch_context'):
+                unity_metadata.write_launch_context(entity, metadata, context_entity)
+        except Exception as e:
+            log.warning('Could not write the Unity launch context file: {}'.format(e))
+
+    def _get_context_entity(self, entity, sg):
+        """
+        Returns the entity (or task) to switch the context to, if any
+        """
+        # Toolkit does not really support launching from a Version or a Note
+        # entity. We need to switch the context back to the supported entity
+        # (or task) for which the Version/Note was created. This is similar 
+        # to what toolkit does when launching from a published file entity.
+        entity_type = entity['type']
+        context_entity = None
+        if entity_type in ['Note', 'Version']:
+            version = entity if entity_type == 'Version' else unity_metadata.get_version_from_note(entity,sg)
+
+            if version:
+                # Fetch the Link ('entity') and Task ('sg_task') fields 
+                found_version = sg.find_one(version['type'], [['id', 'is', version['id']]], ['entity', 'sg_task'])
+                linked_entity = found_version.get('entity')
+
+                if linked_entity:
+                    linked_task = found_version.get('sg_task')
+                    if linked_task:
+                        # Work in the context of the task
+                        linked_entity = linked_task
+
+                    context_entity = { 'type': linked_entity['type'], 'id': linked_entity['id'] }
+            else:
+                log.warning('Could not find a Version entity linked to the Note ({}). Some toolkit features might not be available.'.format(entity))
+
+        return context_entity
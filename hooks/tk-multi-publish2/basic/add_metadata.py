@@ -1,22 +1,86 @@
-from sg_client import GetUnityEngine
+from sg_client import GetUnityEngine, GetUnityEditor
 
 import json
 import os
+import sys
 import sgtk
 
+# Fix-up sys.path so we can access our utils
+utils_path = os.path.split(__file__)[0]
+utils_path = os.path.join(utils_path, os.pardir, os.pardir, 'utils')
+utils_path = os.path.normpath(utils_path)
+if utils_path not in sys.path:
+    sys.path.append(utils_path)
+
+import unity_metadata
+
 HookBaseClass = sgtk.get_hook_baseclass()
 
 ############# METADATA VERSION ################
 # In case we need to write backward-compatible code, we store the metadata
 # version number along with the metadata
-_metadata_version = '1.0'
+#
+# 1.0: project_path, scene_path
+# 1.1: dependencies (GUIDs of the largest assets the scene depends on) and 
+#      timeline (GUID of the main Timeline asset), used to load the assets
+#      before the scene is opened (see unity_scene.warm_dependencies and 
+#      unity_panel.py)
+_metadata_version = '1.1'
+
+# The metadata is read for every row of the Shotgun panel: only the largest
+# dependencies, which are the slowest to load, are stored
+_max_dependencies = 200
 
 logger = sgtk.LogManager.get_logger(__name__)
 
 class UnitySessionAddMetadataPlugin(HookBaseClass):
     """
     Plug-in for adding metadata to the Version entity published by the base class
+
+    The metadata of all the Versions of a publish session is written in a
+    single batch, after the last item is finalized. Each publish run starts a
+    new session, so that the items of a run which failed before being 
+    finalized are not waited for
     """
+    def validate(self, settings, item):
+        """
+        Validates the given item to check that it is ok to publish.
+
+        :param settings: Dictionary of Settings. The keys are strings, matching
+            the keys returned in the settings property. The values are `Setting`
+            instances.
+        :param item: Item to validate
+        :returns: True if item is valid, False otherwise.
+        """
+        # The validation pass starts each publish run
+        session = self._get_publish_session(item)
+        if not session['validating']:
+            session = self._start_publish_session(item)
+            session['validating'] = True
+
+        return super(UnitySessionAddMetadataPlugin, self).validate(settings, item)
+
+    def publish(self, settings, item):
+        """
+        Executes the publish logic for the given item and settings.
+
+        :param settings: Dictionary of Settings. The keys are strings, matching
+            the keys returned in the settings property. The values are `Setting`
+            instances.
+        :param item: Item to process
+        """
+        # Call the base hook
+        super(UnitySessionAddMetadataPlugin, self).publish(settings, item)
+
+        # Remember the items to finalize, to know when the last one is. An 
+        # item is published once per run: if it was already published, this
+        # is a new run, which was not validated first
+        session = self._get_publish_session(item)
+        if id(item) in session['pending_items']:
+            session = self._start_publish_session(item)
+        session['validating'] = False
+        session['pending_items'].add(id(item))
+
     def finalize(self, settings, item):
         """
         Execute the finalization pass. This pass executes once all the publish
@@ -27,41 +91,185 @@ class UnitySessionAddMetadataPlugin(HookBaseClass):
             instances.
         :param item: Item to process
         """
-        # Call the base hook
-        super(UnitySessionAddMetadataPlugin, self).finalize(settings, item)
-        
+        session = self._get_publish_session(item)
+        try:
+            # Call the base hook
+            super(UnitySessionAddMetadataPlugin, self).finalize(settings, item)
+
+            self._queue_metadata_update(session, item)
+        finally:
+            session['pending_items'].discard(id(item))
+            if not session['pending_items']:
+                # The run is over, the next one starts a new session
+                self._publish_session = None
+                self._flush_metadata_updates(session)
+
+    def _get_publish_session(self, item):
+        """
+        Returns the state of the publish session of the passed item, which is
+        reset when a new publish tree is processed
+        """
+        session = getattr(self, '_publish_session', None)
+        if not session or session['root'] is not self._get_root_item(item):
+            session = self._start_publish_session(item)
+        return session
+
+    def _start_publish_session(self, item):
+        """
+        Starts a new publish session for the passed item, discarding the state
+        of the previous run
+        """
+        session = { 'root'          : self._get_root_item(item),
+                    'validating'    : False,
+                    'pending_items' : set(),
+                    'schema_valid'  : None,
+                    'metadata_json' : None,
+                    'updates'       : [] }
+        self._publish_session = session
+        return session
+
+    def _get_root_item(self, item):
+        root = item
+        while root.parent:
+            root = root.parent
+        return root
+
+    def _queue_metadata_update(self, session, item):
         version = item.properties.get('sg_version_data')
         if not version or version.get('type') != 'Version':
             # Not a version entity, we do not add metadata
             return
-        
+
         # Set the Unity Metadata if possible
         engine = sgtk.platform.current_engine()
-        if engine:
-            # Make sure the 'sg_unity_metadata' field exists on Version entities
-            version_fields = engine.shotgun.schema_field_read('Version')
-            if not version_fields.get('sg_unity_metadata') or version_fields['sg_unity_metadata'].get('data_type', {}).get('value', '') != 'text':
+        if not engine:
+            return
+
+        # Make sure the 'sg_unity_metadata' field exists on Version entities,
+        # once per publish session
+        if session['schema_valid'] is None:
+            version_fields = unity_metadata.get_entity_schema('Version', engine.shotgun)
+            session['schema_valid'] = bool(version_fields.get('sg_unity_metadata')) and version_fields['sg_unity_metadata'].get('data_type', {}).get('value', '') == 'text'
+            if not session['schema_valid']:
                 logger.critical("There is no text field 'sg_unity_metadata' on Version entity type. Create one to store Unity metadata when publishing a Version")
-                return
-            else:
-                UnityEngine = GetUnityEngine()
-                data_path = UnityEngine.Application.dataPath
-                project_path = os.path.dirname(data_path)
-                
-                # Get the currently open scene
-                scene = UnityEngine.SceneManagement.SceneManager.GetActiveScene()
-                scene_path = None
-                if scene:
-                    scene_path = scene.path
-        
-                # get the tk-unity engine version            
-                engine_version = engine.version
-                
-                metadata_json = json.dumps(
-                    { 'project_path'    : project_path, 
-                      'scene_path'      : scene_path,
-                      'metadata_version': _metadata_version } )
-
-                # Update the version entity with new metadata                
-                engine.shotgun.update('Version', version['id'], { 'sg_unity_metadata' : metadata_json } )
-        
+        if not session['schema_valid']:
+            return
+
+        # The metadata describes the Unity session, it is the same for all
+        # the Versions
+        if session['metadata_json'] is None:
+            session['metadata_json'] = self._get_metadata_json(engine)
+
+        session['updates'].append(version)
+
+    def _get_metadata_json(self, engine):
+        UnityEngine = GetUnityEngine()
+        data_path = UnityEngine.Application.dataPath
+        project_path = os.path.dirname(data_path)
+
+        # Get the currently open scene
+        scene = UnityEngine.SceneManagement.SceneManager.GetActiveScene()
+        scene_path = None
+        if scene:
+            scene_path = scene.path
+
+        # get the tk-unity engine version
+        engine_version = engine.version
+
+        metadata = { 'project_path'    : project_path,
+                     'scene_path'      : scene_path,
+                     'metadata_version': _metadata_version }
+        if scene_path:
+            (metadata['dependencies'], metadata['timeline']) = self._get_scene_dependencies(engine, scene_path)
+
+        return json.dumps(metadata)
+
+    def _get_scene_dependencies(self, engine, scene_path):
+        """
+        Returns the GUIDs of the largest assets the scene depends on (timeline 
+        first), and the GUID of its main Timeline asset or None
+        """
+        UnityEditor = GetUnityEditor()
+        AssetDatabase = UnityEditor.AssetDatabase
+
+        # Scripts are compiled with the project, not loaded with the scene
+        dependency_paths = [ path for path in AssetDatabase.GetDependencies(scene_path, True)
+                             if path != scene_path and not path.endswith('.cs') ]
+
+        timeline_path = self._get_timeline_path(engine, dependency_paths)
+        max_count = _max_dependencies
+        if timeline_path in dependency_paths:
+            dependency_paths.remove(timeline_path)
+            max_count -= 1
+        if len(dependency_paths) > max_count:
+            self.logger.debug('Only storing the {} largest of the {} dependencies of {}'.format(max_count, len(dependency_paths), scene_path))
+            project_path = os.path.dirname(GetUnityEngine().Application.dataPath)
+            dependency_paths.sort(key=lambda path: self._get_file_size(os.path.join(project_path, path)), reverse=True)
+            dependency_paths = dependency_paths[:max_count]
+        if max_count < _max_dependencies:
+            dependency_paths.insert(0, timeline_path)
+
+        dependencies = [ AssetDatabase.AssetPathToGUID(path) for path in dependency_paths ]
+        timeline = AssetDatabase.AssetPathToGUID(timeline_path) if timeline_path else None
+        return ([ guid for guid in dependencies if guid ], timeline or None)
+
+    def _get_file_size(self, path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+    def _get_timeline_path(self, engine, dependency_paths):
+        """
+        Returns the path of the Timeline asset of the main PlayableDirector
+        (see the main_timeline_tag setting of the Shotgun panel), or of the
+        first Timeline asset the scene depends on
+        """
+        shotgun_panel = engine.apps.get('tk-multi-shotgunpanel')
+        main_timeline_tag = shotgun_panel.get_setting('main_timeline_tag') if shotgun_panel else None
+        if main_timeline_tag:
+            UnityEngine = GetUnityEngine()
+            try:
+                game_objects = UnityEngine.GameObject.FindGameObjectsWithTag(main_timeline_tag)
+                if game_objects:
+                    main_director = game_objects[0].GetComponent(UnityEngine.Playables.PlayableDirector)
+                    if main_director and main_director.playableAsset:
+                        return GetUnityEditor().AssetDatabase.GetAssetPath(main_director.playableAsset)
+            except Exception as e:
+                # e.g. the tag is not defined in the project
+                self.logger.debug('Could not find the main PlayableDirector: {}'.format(e))
+
+        for path in dependency_paths:
+            if path.endswith('.playable'):
+                return path
+        return None
+
+    def _flush_metadata_updates(self, session):
+        """
+        Writes the queued metadata updates in a single batch. Since a batch is
+        all or nothing, the updates are retried one by one if it fails, to
+        report the failures per Version
+        """
+        versions = session['updates']
+        session['updates'] = []
+        if not versions:
+            return
+
+        engine = sgtk.platform.current_engine()
+        data = { 'sg_unity_metadata' : session['metadata_json'] }
+        requests = [ { 'request_type' : 'update',
+                       'entity_type'  : 'Version',
+                       'entity_id'    : version['id'],
+                       'data'         : data } for version in versions ]
+        try:
+            engine.shotgun.batch(requests)
+            self.logger.debug('Added Unity metadata to {} Version(s)'.format(len(versions)))
+            return
+        except Exception as e:
+            self.logger.debug('Could not add Unity metadata in a single batch, updating the Versions one by one: {}'.format(e))
+
+        for version in versions:
+            try:
+                engine.shotgun.update('Version', version['id'], data)
+            except Exception as e:
+                self.logger.error('Could not add Unity metadata to Version "{}" (id {}): {}'.format(version.get('code'), version['id'], e))
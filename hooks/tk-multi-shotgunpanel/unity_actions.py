@@ -1,5 +1,4 @@
 import sgtk
-from sg_client import GetUnityEngine, GetUnityEditor
 
 import json
 import os
@@ -38,8 +37,8 @@ class UnityActions(HookBaseClass):
         :param ui_area: String denoting the UI Area (see above).
         :returns List of dictionaries, each with keys name, params, caption, group and description
         """
-        import unity_metadata
-        
+        import unity_panel
+
         app = self.parent
         app.logger.debug("Generate actions called for UI element %s. "
                       "Actions: %s. Shotgun Data: %s" % (ui_area, actions, sg_data))
@@ -55,23 +54,18 @@ class UnityActions(HookBaseClass):
         main_timeline_tag = app.settings.get('main_timeline_tag')
         if not main_timeline_tag:
             return action_instances
-        
-        # Look for metadata
-        sg = app.context.sgtk.shotgun
-        metadata = unity_metadata.get_metadata_from_entity(sg_data, sg)
-        if not metadata:
-            return action_instances
-        
-        # The metadata should point to the current project
-        if not unity_metadata.relates_to_current_project(metadata):
-            return action_instances
-        
-        # The metadata should point to a scene that exists in the project
-        if not unity_metadata.relates_to_existing_scene(metadata):
+
+        if ui_area == "details":
+            unity_panel.set_details_entity(sg_data)
+
+        # Resolving the action requires Shotgun queries and editor bridge 
+        # calls: it is done in the background, and the entity is focused 
+        # again when its action is resolved (see _check_jump_to_frame)
+        (resolved, metadata) = unity_panel.get_cached_action(sg_data)
+        if not resolved:
+            unity_panel.resolve_action(sg_data, self._fetch_metadata, self._on_metadata_fetched)
             return action_instances
-        
-        # There should be a frame number
-        if not metadata.get('frame_number'):
+        if not metadata:
             return action_instances
         
         # Add the main timeline tag to the passed params
@@ -86,6 +80,83 @@ class UnityActions(HookBaseClass):
 
         return action_instances
 
+    def _fetch_metadata(self, entities):
+        """
+        Returns the metadata of the passed entities keyed by (entity type, 
+        entity id). Only queries Shotgun: called in the background worker of
+        unity_panel
+        """
+        import unity_metadata
+
+        # Shotgun connections are per thread
+        sg = self.parent.context.sgtk.shotgun
+        return unity_metadata.get_metadata_for_entities(entities, sg)
+
+    def _on_metadata_fetched(self, results):
+        # The project and scene checks call the editor
+        self.parent.engine.async_execute_in_main_thread(self._check_jump_to_frame, results)
+
+    def _check_jump_to_frame(self, results):
+        """
+        Stores which of the fetched entities can be jumped to. Called in the 
+        main thread, once per batch of entities fetched by the worker
+        """
+        import unity_metadata
+        import unity_panel
+
+        available = False
+        refocus_key = None
+        for (key, metadata) in results.items():
+            params = None
+            try:
+                # The metadata should point to the current project, to a 
+                # scene that exists in the project, and there should be a 
+                # frame number
+                if (unity_metadata.relates_to_current_project(metadata) and
+                    unity_metadata.relates_to_existing_scene(metadata) and
+                    metadata.get('frame_number')):
+                    params = metadata
+                    available = True
+                    if unity_panel.is_details_entity(key):
+                        refocus_key = key
+            except Exception as e:
+                self.parent.logger.debug('Could not check the Unity metadata of {} {}: {}'.format(key[0], key[1], e))
+            unity_panel.store_action(key, params)
+
+        if not available:
+            return
+        if refocus_key:
+            self._refocus_entity(refocus_key)
+        if self.parent.settings.get('prefetch_scenes'):
+            self._prefetch_scenes()
+
+    def _prefetch_scenes(self):
+        """
+        Warms the dependencies of the scenes the listed notes point to the
+        most (opt-in, see the prefetch_* settings)
+        """
+        import unity_panel
+
+        settings = self.parent.settings
+        try:
+            unity_panel.schedule_prefetch(settings.get('prefetch_max_scenes') or 3,
+                                          settings.get('prefetch_time_budget') or 30,
+                                          settings.get('prefetch_memory_budget'))
+        except Exception as e:
+            # Only an optimization
+            self.parent.logger.debug('Could not prefetch the scenes: {}'.format(e))
+
+    def _refocus_entity(self, key):
+        """
+        Focuses the panel on the entity shown in the details area again, so 
+        that its actions are generated again, with the resolved action
+        """
+        app = self.parent
+        try:
+            app.navigate(key[0], key[1], app.PANEL)
+        except Exception as e:
+            app.logger.debug('Could not refresh the actions of {} {}: {}'.format(key[0], key[1], e))
+
     def execute_action(self, name, params, sg_data):
         """
         Execute a given action. The data sent to this be method will
@@ -101,39 +172,10 @@ class UnityActions(HookBaseClass):
                       "Parameters: %s. Shotgun Data: %s" % (name, params, sg_data))
         
         if name == "jump_to_frame":
-            UnityEditor = GetUnityEditor()
-            UnityEngine = GetUnityEngine()
-            
-            # Open the scene
-            metadata = params
-            frame_number = int(metadata['frame_number'])
-            UnityEditor.SceneManagement.EditorSceneManager.OpenScene(metadata.get('scene_path'))
-
-            # Set the current time            
-            UnityEditor.EditorApplication.ExecuteMenuItem("Window/Sequencing/Timeline")
-        
-            # Find the right director
-            main_director = None
-            game_objects = UnityEngine.GameObject.FindGameObjectsWithTag(params['main_timeline_tag'])
-            if game_objects:
-                main_director = game_objects[0].GetComponent(UnityEngine.Playables.PlayableDirector)
-
-            if main_director:
-                try:
-                    # focus on the PlayableDirector in the Timeline window
-                    UnityEditor.Selection.activeObject = main_director
-                    
-                    timeline = main_director.playableAsset
-                    if timeline:
-                        fps = timeline.editorSettings.fps
-                        main_director.time = frame_number / fps
-                    else:
-                        app.logger.error('Shotgun is unable to jump to frame: The "{}" PlayableDirector does not have a valid Playable Asset assigned.'.format(game_objects[0].name))
-
-                    
-                except Exception as e:
-                    app.logger.error('Unable to Jump to Frame: ' + str(e))
-            else:
-                app.logger.error('Shotgun is unable to jump to frame: please choose a PlayableDirector and tag it with "{}".'.format(params['main_timeline_tag']))
+            import unity_panel
+            import unity_scene
+            # The jump takes precedence over the prefetch
+            unity_panel.stop_prefetch('jump to frame')
+            unity_scene.jump_to_frame(params, params['main_timeline_tag'], app.logger, app.settings.get('scene_open_mode'))
         else:
             super(UnityActions, self).execute_action(name, params, sg_data)
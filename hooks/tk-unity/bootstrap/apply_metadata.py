@@ -1,12 +1,12 @@
 # Shotgun
 import sgtk
-from sg_client import GetUnityEditor
 
 # misc
 import json
 import os
 import pprint
 import sys
+import threading
 
 # Fix-up sys.path so we can access our utils
 utils_path = os.path.split(__file__)[0]
@@ -25,22 +25,152 @@ class UnityApplyMetadata(HookBaseClass):
         In this specific hook we parse the sg_unity_metadata that is defined for 
         the entity related to the context from which we just bootstrapped and 
         we try to apply it (open scene) 
+
+        The metadata is resolved in a background thread, and the scene is 
+        opened on a later editor update, so that the engine initialization 
+        does not wait for Shotgun
         """
-        import unity_metadata
+        import launch_trace
         engine = self.parent
         
-        # Call the base class
-        super(UnityApplyMetadata, self).on_post_init()
+        with launch_trace.span('apply_metadata'):
+            with launch_trace.span('post_init'):
+                # Call the base class
+                super(UnityApplyMetadata, self).on_post_init()
+
+            self._start_applying_metadata(engine)
+
+        # Accept the launch requests for this project, so that launching it 
+        # again from Shotgun reuses this editor (see unity_editors.py)
+        self._start_launch_request_server(engine)
+
+    def _start_launch_request_server(self, engine):
+        import unity_editors
+        import unity_metadata
+
+        def on_launch_request(launch_context):
+            # Called from the server thread
+            engine.async_execute_in_main_thread(self._apply_launch_request, engine, launch_context)
+
+        try:
+            unity_editors.start_launch_request_server(unity_metadata.get_loaded_project(), on_launch_request)
+        except Exception as e:
+            self.logger.warning('Could not start the Unity launch request server: {}'.format(e))
+
+    def _apply_launch_request(self, engine, launch_context):
+        """
+        Applies the metadata of a launch request delivered by the launcher: 
+        opens the scene, and jumps to the frame if there is one
+        """
+        import unity_metadata
+        import unity_scene
+
+        metadata = launch_context.get('metadata')
+        if not metadata:
+            return
+
+        # Takes precedence over the metadata of the bootstrap
+        self._metadata_request = None
+
+        if not unity_metadata.relates_to_current_project(metadata):
+            self.logger.warning('Not applying Shotgun metadata as it does not relate to the currently loaded project. Metadata = "{}")'.format(pprint.pformat(metadata)))
+            return
+
+        if not unity_metadata.relates_to_existing_scene(metadata):
+            return
+
+        main_timeline_tag = self._get_shotgun_panel_setting(engine, 'main_timeline_tag')
+        open_mode = self._get_shotgun_panel_setting(engine, 'scene_open_mode')
+
+        if metadata.get('frame_number') and main_timeline_tag:
+            unity_scene.jump_to_frame(metadata, main_timeline_tag, self.logger, open_mode)
+        else:
+            unity_scene.open_scene(metadata.get('scene_path'), open_mode, metadata=metadata)
+
+    def _get_shotgun_panel_setting(self, engine, name):
+        """
+        Returns the value of a setting of the Shotgun panel (e.g. 
+        main_timeline_tag), or None
+        """
+        shotgun_panel = engine.apps.get('tk-multi-shotgunpanel')
+        if not shotgun_panel:
+            return None
+        return shotgun_panel.get_setting(name)
+
+    def _start_applying_metadata(self, engine):
+        """
+        Starts resolving the metadata of the entity we launched from in a 
+        background thread
+        """
+        from sg_client import GetUnityEngine
 
         # Get metadata from the entity we launched from
         launch_entity_type = os.environ.get('SHOTGUN_LAUNCH_ENTITY_TYPE')
         launch_entity_id = os.environ.get('SHOTGUN_LAUNCH_ENTITY_ID')
-        if launch_entity_id:
-            launch_entity_id = int(launch_entity_id)
+        if not launch_entity_type or not launch_entity_id:
+            return
 
-        launch_entity = { 'type':launch_entity_type, 'id':launch_entity_id }
-        metadata = unity_metadata.get_metadata_from_entity(launch_entity, engine.sgtk.shotgun)
-        if not metadata:
+        launch_entity = { 'type':launch_entity_type, 'id':int(launch_entity_id) }
+
+        # The metadata is not applied if the user opens another scene in the 
+        # meantime, or if a launch request arrives first
+        initial_scene_path = GetUnityEngine().SceneManagement.SceneManager.GetActiveScene().path
+        request = object()
+        self._metadata_request = request
+
+        thread = threading.Thread(target=self._resolve_metadata,
+                                  args=(engine, launch_entity, request, initial_scene_path),
+                                  name='Shotgun metadata resolution')
+        thread.daemon = True
+        thread.start()
+
+    def _resolve_metadata(self, engine, launch_entity, request, initial_scene_path):
+        """
+        Resolves the metadata, in the background thread, and schedules its 
+        application in the main thread
+        """
+        import launch_trace
+        import unity_metadata
+
+        try:
+            # Use the metadata resolved by the launcher if available. Only 
+            # query Shotgun when the launch context file is missing (e.g. the
+            # launcher could not reach the site) or stale
+            with launch_trace.span('resolve_metadata'):
+                launch_context = unity_metadata.read_launch_context(launch_entity)
+                # This editor is the only consumer of the file
+                unity_metadata.remove_launch_context()
+                if launch_context:
+                    metadata = launch_context.get('metadata')
+                else:
+                    # Shotgun connections are per thread
+                    sg = launch_trace.traced_shotgun(engine.sgtk.shotgun)
+                    metadata = unity_metadata.get_cached_metadata_from_entity(launch_entity, sg)
+        except Exception as e:
+            self.logger.warning('Could not get the Shotgun metadata of {} {}: {}'.format(launch_entity['type'], launch_entity['id'], e))
+            return
+
+        if metadata:
+            engine.async_execute_in_main_thread(self._schedule_metadata_application, engine, metadata, request, initial_scene_path)
+
+    def _is_metadata_request_cancelled(self, request, initial_scene_path):
+        from sg_client import GetUnityEngine
+
+        if getattr(self, '_metadata_request', None) is not request:
+            self.logger.debug('Not applying the Shotgun metadata of the launch entity: superseded by a launch request')
+            return True
+
+        if GetUnityEngine().SceneManagement.SceneManager.GetActiveScene().path != initial_scene_path:
+            self.logger.debug('Not applying the Shotgun metadata of the launch entity: another scene was opened')
+            return True
+
+        return False
+
+    def _schedule_metadata_application(self, engine, metadata, request, initial_scene_path):
+        import unity_metadata
+        import unity_scene
+
+        if self._is_metadata_request_cancelled(request, initial_scene_path):
             return
 
         # Make sure the right project is currently loaded
@@ -54,7 +184,22 @@ class UnityApplyMetadata(HookBaseClass):
         # Find the scene to open
         if not unity_metadata.relates_to_existing_scene(metadata):
             return
-        
+
+        # Load the scene dependencies on the next editor updates, then open
+        # the scene, so that opening it does not stall on each of them
+        unity_scene.warm_dependencies(metadata,
+                                      lambda: self._apply_metadata(engine, metadata, request, initial_scene_path),
+                                      lambda: self._is_metadata_request_cancelled(request, initial_scene_path))
+
+    def _apply_metadata(self, engine, metadata, request, initial_scene_path):
+        import launch_trace
+        import unity_scene
+
+        if self._is_metadata_request_cancelled(request, initial_scene_path):
+            return
+        self._metadata_request = None
+
         # open the correct scene in Unity
-        GetUnityEditor().SceneManagement.EditorSceneManager.OpenScene(metadata.get('scene_path'))
-        
\ No newline at end of file
+        with launch_trace.span('open_scene'):
+            launch_trace.count_bridge_calls()
+            unity_scene.open_scene(metadata.get('scene_path'), self._get_shotgun_panel_setting(engine, 'scene_open_mode'), metadata=metadata)
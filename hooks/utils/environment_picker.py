@@ -0,0 +1,163 @@
+"""
+Table-driven environment picker used by the pick_environment core hook
+
+The environment to use for a context is looked up in a dispatch table built
+from core/pick_environment.yml, keyed by:
+
+    (source entity type, has project, entity type, has step)
+
+which is all the picked environment depends on. Results are memoized per key.
+
+A micro-benchmark exercising all the rules of the table can be run with:
+
+    python environment_picker.py --benchmark [--iterations N]
+"""
+import os
+import sys
+
+TABLE_PATH = os.path.join('core', 'pick_environment.yml')
+
+_MISSING = object()
+
+class EnvironmentPicker(object):
+    """
+    Picks environments from a table (see core/pick_environment.yml)
+    """
+    CACHE_MAX_SIZE = 128
+
+    def __init__(self, table):
+        self._source_entities = dict(table.get('source_entities') or {})
+        self._no_project = table.get('no_project')
+        self._no_entity = table.get('no_entity')
+
+        self._entities = {}
+        for (entity_type, environments) in (table.get('entities') or {}).items():
+            environments = environments or {}
+            self._entities[(entity_type, False)] = environments.get('without_step')
+            self._entities[(entity_type, True)] = environments.get('with_step')
+
+        # Single dictionary operations are atomic, no lock is needed
+        self._cache = {}
+
+    @staticmethod
+    def get_key(context):
+        """
+        Returns the identity tuple of the passed context: the values the
+        picked environment depends on
+        """
+        source_entity = context.source_entity
+        entity = context.entity
+        return (source_entity['type'] if source_entity else None,
+                context.project is not None,
+                entity['type'] if entity else None,
+                context.step is not None)
+
+    def _pick(self, key):
+        (source_type, has_project, entity_type, has_step) = key
+
+        environment = self._source_entities.get(source_type)
+        if environment:
+            return environment
+
+        if not has_project:
+            # Our context is completely empty. We're going into the site context.
+            return self._no_project
+
+        if entity_type is None:
+            # We have a project but not an entity.
+            return self._no_entity
+
+        return self._entities.get((entity_type, has_step))
+
+    def pick(self, context):
+        """
+        Returns the name of the environment to use for the passed context, or
+        None
+        """
+        key = self.get_key(context)
+        environment = self._cache.get(key, _MISSING)
+        if environment is _MISSING:
+            environment = self._pick(key)
+            if len(self._cache) >= self.CACHE_MAX_SIZE:
+                self._cache.clear()
+            self._cache[key] = environment
+        return environment
+
+_pickers = {}
+
+def get_picker(config_root):
+    """
+    Returns the picker for the table of the passed configuration, loading the
+    table once per process
+    """
+    picker = _pickers.get(config_root)
+    if picker is None:
+        from tank.util.yaml_cache import g_yaml_cache
+
+        table = g_yaml_cache.get(os.path.join(config_root, TABLE_PATH)) or {}
+        picker = _pickers[config_root] = EnvironmentPicker(table)
+    return picker
+
+class _BenchmarkContext(object):
+    def __init__(self, project, entity, step, source_entity):
+        self.project = project
+        self.entity = entity
+        self.step = step
+        self.source_entity = source_entity
+
+def _benchmark(table, iterations):
+    import timeit
+
+    project = { 'type': 'Project', 'id': 1 }
+    step = { 'type': 'Step', 'id': 1 }
+    contexts = [ _BenchmarkContext(None, None, None, None),
+                 _BenchmarkContext(project, None, None, None),
+                 _BenchmarkContext(project, { 'type': 'CustomEntity01', 'id': 1 }, None, None) ]
+    for source_type in table.get('source_entities') or {}:
+        contexts.append(_BenchmarkContext(project, { 'type': 'Shot', 'id': 1 }, None, { 'type': source_type, 'id': 1 }))
+    for entity_type in table.get('entities') or {}:
+        for context_step in (None, step):
+            contexts.append(_BenchmarkContext(project, { 'type': entity_type, 'id': 1 }, context_step, None))
+
+    print('{} contexts, {} iterations'.format(len(contexts), iterations))
+    for (name, use_cache) in (('uncached', False), ('memoized', True)):
+        picker = EnvironmentPicker(table)
+        if use_cache:
+            pick = picker.pick
+        else:
+            pick = lambda context: picker._pick(picker.get_key(context))
+
+        def run():
+            for context in contexts:
+                pick(context)
+
+        duration = min(timeit.repeat(run, number=iterations, repeat=3))
+        print('{:>10}: {:.3f} us per pick'.format(name, duration * 1e6 / (iterations * len(contexts))))
+
+    picker = EnvironmentPicker(table)
+    for context in contexts:
+        print('    {} -> {}'.format(EnvironmentPicker.get_key(context), picker.pick(context)))
+
+def _main(argv):
+    import argparse
+
+    default_root = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir))
+
+    parser = argparse.ArgumentParser(description='Benchmark the environment picker')
+    parser.add_argument('--benchmark', action='store_true', required=True)
+    parser.add_argument('--iterations', type=int, default=100000)
+    parser.add_argument('--config-root', default=default_root)
+    args = parser.parse_args(argv)
+
+    try:
+        import yaml
+    except ImportError:
+        from tank_vendor import yaml
+    with open(os.path.join(args.config_root, TABLE_PATH)) as f:
+        table = yaml.safe_load(f)
+
+    _benchmark(table, args.iterations)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(_main(sys.argv[1:]))
@@ -0,0 +1,252 @@
+"""
+Launch latency tracing
+
+Records timing spans for the phases of a Unity launch: the launcher hooks
+(before_app_launch.py, app_launch.py) in the Shotgun Desktop process and the
+tk-unity bootstrap (apply_metadata.py) in the Unity process. Each span records
+its wall time and the number of Shotgun and Python/C# bridge calls made while
+it was open.
+
+Tracing is enabled by setting SHOTGUN_UNITY_LAUNCH_TRACE to the path of a
+JSON-lines file. Spans of all the processes are appended to that file, and
+correlated by a launch ID that before_app_launch.py stores in the
+SHOTGUN_UNITY_LAUNCH_ID environment variable, which the launched process
+inherits.
+
+The trace file can be summarized with:
+
+    python launch_trace.py TRACE_FILE [--launch-id ID] [--folded]
+
+which prints a per-phase breakdown of each launch, and a flame-style summary
+(or folded stacks suitable for flamegraph.pl with --folded).
+"""
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+
+TRACE_FILE_ENV_VAR = 'SHOTGUN_UNITY_LAUNCH_TRACE'
+LAUNCH_ID_ENV_VAR = 'SHOTGUN_UNITY_LAUNCH_ID'
+
+_write_lock = threading.Lock()
+# Span stack and call counters of the current thread: spans open at the same
+# time in different threads only count the calls of their own thread
+_local = threading.local()
+
+def is_enabled():
+    return bool(os.environ.get(TRACE_FILE_ENV_VAR))
+
+def start_launch():
+    """
+    Starts a new launch: generates a new launch ID and stores it in the
+    environment so that the launched process inherits it
+    """
+    launch_id = uuid.uuid4().hex
+    os.environ[LAUNCH_ID_ENV_VAR] = launch_id
+    return launch_id
+
+def get_launch_id():
+    return os.environ.get(LAUNCH_ID_ENV_VAR)
+
+def _get_thread_counters():
+    counters = getattr(_local, 'counters', None)
+    if counters is None:
+        counters = _local.counters = { 'shotgun_calls': 0, 'bridge_calls': 0 }
+    return counters
+
+def count_shotgun_calls(count=1):
+    _get_thread_counters()['shotgun_calls'] += count
+
+def count_bridge_calls(count=1):
+    _get_thread_counters()['bridge_calls'] += count
+
+def _get_counters():
+    return dict(_get_thread_counters())
+
+class _TracedShotgun(object):
+    """
+    Proxy to a Shotgun connection that counts the API calls made through it
+    """
+    def __init__(self, sg):
+        self._sg = sg
+
+    def __getattr__(self, name):
+        value = getattr(self._sg, name)
+        if name.startswith('_') or not callable(value):
+            return value
+
+        @functools.wraps(value)
+        def counted(*args, **kwargs):
+            count_shotgun_calls()
+            return value(*args, **kwargs)
+        return counted
+
+def traced_shotgun(sg):
+    """
+    Returns a Shotgun connection that counts its calls when tracing is
+    enabled, or the passed connection otherwise
+    """
+    if not sg or not is_enabled() or isinstance(sg, _TracedShotgun):
+        return sg
+    return _TracedShotgun(sg)
+
+def _write(record):
+    path = os.environ.get(TRACE_FILE_ENV_VAR)
+    line = json.dumps(record) + '\n'
+    with _write_lock:
+        try:
+            with open(path, 'a') as f:
+                f.write(line)
+        except Exception:
+            # Tracing must never break a launch
+            pass
+
+class span(object):
+    """
+    Context manager recording a timing span. Spans opened while another span
+    is open in the same thread are recorded as its children
+    """
+    def __init__(self, name, **attributes):
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self):
+        if not is_enabled():
+            self._start = None
+            return self
+
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        self._parent = stack[-1] if stack else None
+        self._path = (self._parent._path + ';' if self._parent else '') + self.name
+        stack.append(self)
+
+        self._start_counters = _get_counters()
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self._start is None:
+            return False
+
+        end = time.time()
+        end_counters = _get_counters()
+        _local.stack.pop()
+
+        record = { 'launch_id'     : get_launch_id(),
+                   'pid'           : os.getpid(),
+                   'process'       : os.path.basename(sys.executable),
+                   'span'          : self.name,
+                   'path'          : self._path,
+                   'parent'        : self._parent.name if self._parent else None,
+                   'start'         : self._start,
+                   'end'           : end,
+                   'duration'      : end - self._start,
+                   'shotgun_calls' : end_counters['shotgun_calls'] - self._start_counters['shotgun_calls'],
+                   'bridge_calls'  : end_counters['bridge_calls'] - self._start_counters['bridge_calls'],
+                   'error'         : repr(exc_value) if exc_value else None }
+        if self.attributes:
+            record['attributes'] = self.attributes
+        _write(record)
+        return False
+
+def traced(name):
+    """
+    Decorator recording a span for each call of the decorated function
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def _read_records(trace_path, launch_id=None):
+    records = []
+    with open(trace_path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if launch_id and record.get('launch_id') != launch_id:
+                continue
+            records.append(record)
+    return records
+
+def _print_launch(launch_id, records, folded):
+    records = sorted(records, key=lambda record: record['start'])
+    launch_start = records[0]['start']
+    launch_end = max(record['end'] for record in records)
+
+    totals = {}
+    for record in records:
+        key = (record['pid'], record['path'])
+        total = totals.setdefault(key, [0.0, 0, 0, 0, record['start']])
+        total[0] += record['duration']
+        total[1] += 1
+        total[2] += record['shotgun_calls']
+        total[3] += record['bridge_calls']
+
+    if folded:
+        # Self time per stack, in milliseconds
+        for (pid, path), total in totals.items():
+            children = sum(child_total[0] for (child_pid, child_path), child_total in totals.items()
+                           if child_pid == pid and child_path.rsplit(';', 1)[0] == path and child_path != path)
+            print('{} {}'.format(path, int(max(total[0] - children, 0) * 1000)))
+        return
+
+    print('Launch {}: {:.3f} s'.format(launch_id, launch_end - launch_start))
+
+    # Per-phase breakdown: top level spans of each process, in order, with
+    # the time between phases (e.g. the editor start up)
+    print('  Phases:')
+    previous_end = launch_start
+    for record in records:
+        if record['parent']:
+            continue
+        gap = record['start'] - previous_end
+        if gap > 0.001:
+            print('    {:>9.3f} s  (between phases)'.format(gap))
+        print('    {:>9.3f} s  {} [pid {}] shotgun calls: {}, bridge calls: {}'.format(
+            record['duration'], record['span'], record['pid'],
+            record['shotgun_calls'], record['bridge_calls']))
+        previous_end = max(previous_end, record['end'])
+
+    # Flame-style summary: total time per stack
+    print('  Summary:')
+    for (pid, path), total in sorted(totals.items(), key=lambda item: item[1][4]):
+        (duration, count, shotgun_calls, bridge_calls, _) = total
+        depth = path.count(';')
+        name = path.split(';')[-1]
+        bar = '#' * max(1, int(40 * duration / max(launch_end - launch_start, 1e-6)))
+        print('    {:<50} {:>9.3f} s x{:<3} sg: {:<4} bridge: {:<5} {}'.format(
+            '  ' * depth + name, duration, count, shotgun_calls, bridge_calls, bar))
+
+def _main(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Summarize a Unity launch trace file')
+    parser.add_argument('trace_file')
+    parser.add_argument('--launch-id', help='Only report this launch')
+    parser.add_argument('--folded', action='store_true', help='Print folded stacks for flamegraph.pl')
+    args = parser.parse_args(argv)
+
+    launches = {}
+    for record in _read_records(args.trace_file, args.launch_id):
+        launches.setdefault(record.get('launch_id'), []).append(record)
+
+    for launch_id, records in sorted(launches.items(), key=lambda item: min(r['start'] for r in item[1])):
+        _print_launch(launch_id, records, args.folded)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(_main(sys.argv[1:]))
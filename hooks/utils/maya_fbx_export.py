@@ -0,0 +1,391 @@
+"""
+Out-of-process FBX export
+
+Exporting a heavy Maya scene as FBX freezes the interactive session for the
+whole export. Instead, the saved scene can be exported by a headless mayapy
+worker process running this module:
+
+    mayapy maya_fbx_export.py SCENE_PATH FBX_PATH [--options OPTIONS] [--nodes NODE ...]
+
+The whole scene is exported, or only the passed nodes (e.g. the top-level
+group or the selection set of an asset).
+
+The worker reports its progress and errors on its standard output, one
+message per line:
+
+    SGTK_FBX_EXPORT {"type": "progress", "message": "..."}
+    SGTK_FBX_EXPORT {"type": "error", "message": "..."}
+    SGTK_FBX_EXPORT {"type": "done", "path": "...", "duration": 12.3,
+                     "checksum": "...", "size": 1234}
+
+The checksum (sha1) and size of the FBX are computed by the worker in a
+single pass right after writing it, while the file is still in the page
+cache, so that the interactive session never reads it back.
+
+Any other output (e.g. Maya warnings) is relayed as is. FBXExportProcess
+starts a worker from the interactive session and collects these messages.
+FBXExportPool runs several workers concurrently, at most
+SHOTGUN_FBX_EXPORT_WORKERS at a time (default: 4, or less on machines with
+fewer cores), since each of them is a full Maya session.
+
+This module must not import sgtk: it is also run by a bare mayapy.
+"""
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+MESSAGE_PREFIX = 'SGTK_FBX_EXPORT '
+
+DEFAULT_OPTIONS = 'v=0;'
+
+# Bumped whenever the way the FBX is exported (or the content hash) changes,
+# so that the content hashes of older exports no longer match
+CONTENT_HASH_FORMAT = 2
+
+_READ_CHUNK_SIZE = 1024 * 1024
+
+DEFAULT_MAX_WORKERS = 4
+
+# Environment variables removed from the environment of the workers, so that
+# mayapy does not bootstrap a toolkit engine on startup
+_BOOTSTRAP_ENV_VARS = ['SGTK_ENGINE', 'SGTK_CONTEXT', 'SGTK_FILE_TO_OPEN', 'SGTK_LOAD_MAYA_PLUGINS']
+
+def get_mayapy_path():
+    """
+    Returns the path to the mayapy executable of the running Maya, or None
+    """
+    names = ['mayapy.exe'] if sys.platform == 'win32' else ['mayapy']
+    folders = [os.path.dirname(sys.executable)]
+    maya_location = os.environ.get('MAYA_LOCATION')
+    if maya_location:
+        folders.append(os.path.join(maya_location, 'bin'))
+    for folder in folders:
+        for name in names:
+            path = os.path.join(folder, name)
+            if os.path.isfile(path):
+                return path
+    return None
+
+# sha1 of the files hashed by compute_content_hash, keyed by (path, size,
+# mtime), so that publishing again only reads the files which changed
+_file_digests = {}
+_file_digests_lock = threading.Lock()
+
+def _get_file_digest(path):
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    with _file_digests_lock:
+        digest = _file_digests.get(key)
+    if digest is None:
+        digest = compute_checksum(path)[0]
+        with _file_digests_lock:
+            _file_digests[key] = digest
+    return digest
+
+def compute_content_hash(paths, options=DEFAULT_OPTIONS, exporter_version=None, extra_data=None):
+    """
+    Returns the content hash of an export: the sha1 of the contents of the
+    passed files (the scene and its references), of the export options, of
+    the exporter version and of the passed extra data (e.g. the exported
+    nodes)
+
+    The digests of the files are memoized per (path, size, mtime)
+    """
+    content_hash = hashlib.sha1()
+    content_hash.update('{}\0{}\0{}\0'.format(CONTENT_HASH_FORMAT, options, exporter_version).encode('utf-8'))
+    if extra_data:
+        content_hash.update(extra_data.encode('utf-8') + b'\0')
+    for path in paths:
+        content_hash.update(_get_file_digest(path).encode('utf-8') + b'\0')
+    return content_hash.hexdigest()
+
+def compute_checksum(path):
+    """
+    Returns (sha1, size) of the passed file, read in a single pass
+    """
+    checksum = hashlib.sha1()
+    size = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_READ_CHUNK_SIZE), b''):
+            checksum.update(chunk)
+            size += len(chunk)
+    return (checksum.hexdigest(), size)
+
+def link_or_copy(source_path, target_path):
+    """
+    Hard links the source file to the target path, or copies it if it cannot
+    be linked (e.g. across file systems)
+    """
+    import shutil
+
+    if os.path.lexists(target_path):
+        os.remove(target_path)
+    try:
+        os.link(source_path, target_path)
+    except (AttributeError, OSError):
+        shutil.copy2(source_path, target_path)
+
+class FBXExportProcess(object):
+    """
+    FBX export running in a mayapy worker process
+    """
+    def __init__(self, scene_path, fbx_path, options=DEFAULT_OPTIONS, mayapy_path=None, nodes=None):
+        self.scene_path = scene_path
+        self.fbx_path = fbx_path
+        self.options = options
+        self.mayapy_path = mayapy_path or get_mayapy_path()
+        self.nodes = nodes
+
+        self.start_time = None
+        self.duration = None
+        self.error = None
+        self.succeeded = False
+        # sha1 and size of the exported FBX
+        self.checksum = None
+        self.size = None
+
+        self._process = None
+        self._messages = queue.Queue()
+        self._reader = None
+        # Set when queued in a pool
+        self._pool = None
+
+    def start(self):
+        if not self.mayapy_path:
+            raise RuntimeError('Could not find the mayapy executable')
+
+        env = dict(os.environ)
+        for name in _BOOTSTRAP_ENV_VARS:
+            env.pop(name, None)
+        env['MAYA_SKIP_USERSETUP_PY'] = '1'
+        env['PYTHONUNBUFFERED'] = '1'
+
+        args = [self.mayapy_path, os.path.abspath(__file__).replace('.pyc', '.py'),
+                self.scene_path, self.fbx_path, '--options', self.options]
+        if self.nodes:
+            args += ['--nodes'] + list(self.nodes)
+
+        kwargs = {}
+        if sys.platform == 'win32':
+            # Do not open a console window
+            kwargs['creationflags'] = 0x08000000 # CREATE_NO_WINDOW
+
+        self.start_time = time.time()
+        self._process = subprocess.Popen(args, env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                         stderr=subprocess.STDOUT, **kwargs)
+        self._process.stdin.close()
+
+        self._reader = threading.Thread(target=self._read_output, name='FBX export reader')
+        self._reader.daemon = True
+        self._reader.start()
+
+    def _read_output(self):
+        for line in iter(self._process.stdout.readline, b''):
+            line = line.decode('utf-8', 'replace').rstrip()
+            if not line:
+                continue
+            if line.startswith(MESSAGE_PREFIX):
+                try:
+                    message = json.loads(line[len(MESSAGE_PREFIX):])
+                except ValueError:
+                    message = { 'type': 'output', 'message': line }
+            else:
+                message = { 'type': 'output', 'message': line }
+            self._messages.put(message)
+        self._process.stdout.close()
+
+    def is_running(self):
+        if self._process is None:
+            # Still queued in a pool, unless it failed to start
+            return self._pool is not None and self.error is None
+        return self._process.poll() is None or self._reader.is_alive()
+
+    def get_messages(self):
+        """
+        Returns the messages received since the last call, and updates the
+        state of the export from them
+        """
+        messages = []
+        while True:
+            try:
+                message = self._messages.get_nowait()
+            except queue.Empty:
+                break
+            if message.get('type') == 'error':
+                self.error = message.get('message')
+            elif message.get('type') == 'done':
+                self.succeeded = True
+                self.checksum = message.get('checksum')
+                self.size = message.get('size')
+            messages.append(message)
+        return messages
+
+    def wait(self, on_message=None, on_idle=None, poll_interval=0.1):
+        """
+        Waits for the worker to exit, calling on_message for each message
+        received and on_idle between polls (e.g. to process UI events).
+        Returns True if the export succeeded
+        """
+        while True:
+            if self._pool:
+                self._pool.update()
+            running = self.is_running()
+            for message in self.get_messages():
+                if on_message:
+                    on_message(message)
+            if not running:
+                break
+            if on_idle:
+                on_idle()
+            time.sleep(poll_interval)
+
+        if self._process is None:
+            # Failed to start
+            self.duration = 0.0
+            return False
+
+        self.duration = time.time() - self.start_time
+        returncode = self._process.wait()
+        if returncode != 0:
+            self.succeeded = False
+            if not self.error:
+                self.error = 'The FBX export process exited with code {}'.format(returncode)
+        elif not self.succeeded and not self.error:
+            self.error = 'The FBX export process exited without exporting'
+        return self.succeeded
+
+    def cancel(self):
+        if self._process and self._process.poll() is None:
+            self._process.kill()
+
+def get_max_workers():
+    """
+    Returns the maximum number of concurrent workers
+    """
+    max_workers = os.environ.get('SHOTGUN_FBX_EXPORT_WORKERS')
+    if max_workers:
+        return max(1, int(max_workers))
+    try:
+        import multiprocessing
+        return max(1, min(DEFAULT_MAX_WORKERS, multiprocessing.cpu_count() // 2))
+    except NotImplementedError:
+        return 1
+
+class FBXExportPool(object):
+    """
+    Runs FBX export processes, at most max_workers at a time. Queued exports
+    are started as running ones exit, whenever the pool is updated (which
+    FBXExportProcess.wait does)
+    """
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or get_max_workers()
+        self._queued = []
+        self._running = []
+
+    def submit(self, export_process):
+        export_process._pool = self
+        self._queued.append(export_process)
+        self.update()
+
+    def update(self):
+        self._running = [export_process for export_process in self._running if export_process.is_running()]
+        while self._queued and len(self._running) < self.max_workers:
+            export_process = self._queued.pop(0)
+            try:
+                export_process.start()
+            except Exception as e:
+                export_process.error = 'Failed to start the FBX export: {}'.format(e)
+                continue
+            self._running.append(export_process)
+
+_export_pool = None
+
+def get_export_pool():
+    """
+    Returns the pool shared by all the exports of the process
+    """
+    global _export_pool
+    if _export_pool is None:
+        _export_pool = FBXExportPool()
+    return _export_pool
+
+################################################################################
+# Worker
+
+def _send(message_type, **values):
+    values['type'] = message_type
+    sys.stdout.write(MESSAGE_PREFIX + json.dumps(values) + '\n')
+    sys.stdout.flush()
+
+def export_fbx(scene_path, fbx_path, options=DEFAULT_OPTIONS, nodes=None):
+    """
+    Opens the scene and exports it (or the passed nodes) as FBX, in a
+    standalone Maya
+    """
+    start = time.time()
+    _send('progress', message='Initializing Maya')
+    import maya.standalone
+    maya.standalone.initialize(name='python')
+    try:
+        _export_fbx(scene_path, fbx_path, options, nodes)
+    finally:
+        maya.standalone.uninitialize()
+
+    (checksum, size) = compute_checksum(fbx_path)
+    _send('done', path=fbx_path, duration=time.time() - start, checksum=checksum, size=size)
+
+def _export_fbx(scene_path, fbx_path, options, nodes):
+    import maya.cmds as cmds
+
+    if not cmds.pluginInfo('fbxmaya', loaded=True, query=True):
+        cmds.loadPlugin('fbxmaya')
+
+    _send('progress', message='Opening {}'.format(scene_path))
+    cmds.file(scene_path, open=True, force=True, prompt=False)
+
+    _send('progress', message='Exporting {}'.format(fbx_path))
+    fbx_folder = os.path.dirname(fbx_path)
+    if not os.path.isdir(fbx_folder):
+        os.makedirs(fbx_folder)
+    if nodes:
+        # Selecting a set selects its members
+        cmds.select(nodes, replace=True)
+        cmds.file(fbx_path, force=True, options=options, typ='FBX export', pr=True, es=True)
+    else:
+        cmds.file(fbx_path, force=True, options=options, typ='FBX export', pr=True, ea=True)
+
+def _main(argv):
+    import argparse
+    import traceback
+
+    parser = argparse.ArgumentParser(description='Export a Maya scene as FBX')
+    parser.add_argument('scene_path')
+    parser.add_argument('fbx_path')
+    parser.add_argument('--options', default=DEFAULT_OPTIONS)
+    parser.add_argument('--nodes', nargs='*')
+    args = parser.parse_args(argv)
+
+    try:
+        export_fbx(args.scene_path, args.fbx_path, args.options, args.nodes)
+    except Exception as e:
+        _send('error', message='{}\n{}'.format(e, traceback.format_exc()))
+        # Do not leave a partial FBX behind
+        if os.path.isfile(args.fbx_path):
+            try:
+                os.remove(args.fbx_path)
+            except OSError:
+                pass
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(_main(sys.argv[1:]))
@@ -0,0 +1,294 @@
+"""
+Template index for resolving paths to templates
+
+core/templates.yml defines hundreds of path templates. Resolving an arbitrary
+path to its template by trying the template regexes one by one does not scale,
+so this index groups the templates by root and by path component in a trie:
+
+- static components (e.g. "sequences", "work") are exact edges
+- components with keys (e.g. "{Shot}", "{name}.v{version}.ma") are wildcard
+  edges
+- the static suffix of the last component (e.g. ".ma") is checked before
+  testing a template
+
+Resolving a path walks the trie of each root the path is under (roots may be
+nested) and only tests the few templates found at the end of the walks.
+Templates with optional sections ("[_{key}]") are indexed once per variant.
+
+The index is built once per toolkit API instance (see get_template_index).
+The FBX publish plugin of Maya resolves the work template of the session
+with it when the collector does not define one.
+
+A benchmark resolving synthetic paths against the shipped templates.yml can
+be run with:
+
+    python template_index.py --benchmark [--paths N]
+"""
+import os
+import re
+import sys
+
+_OPTIONAL_SECTION_REGEX = re.compile(r'\[([^\[\]]*)\]')
+_WILDCARD = None
+
+def _case_key(value):
+    # Paths are case-insensitive on Windows
+    return value.lower() if sys.platform == 'win32' else value
+
+def expand_optional_sections(definition):
+    """
+    Returns the definitions obtained by keeping or removing each optional
+    section of the passed definition
+    """
+    match = _OPTIONAL_SECTION_REGEX.search(definition)
+    if not match:
+        return [definition]
+
+    with_section = definition[:match.start()] + match.group(1) + definition[match.end():]
+    without_section = definition[:match.start()] + definition[match.end():]
+    return expand_optional_sections(with_section) + expand_optional_sections(without_section)
+
+class _Node(object):
+    __slots__ = ('children', 'templates')
+
+    def __init__(self):
+        # Keys are static components, or _WILDCARD
+        self.children = {}
+        # (static suffix of the last component, template) tuples
+        self.templates = []
+
+class TemplateIndex(object):
+    """
+    Index of templates by root and path components. The indexed templates
+    can be any object, the index only uses their root and definitions
+    """
+    def __init__(self):
+        self._roots = {}
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, template, root_path, definition):
+        """
+        Indexes a template, given its root path and its definition relative
+        to the root (which may contain optional sections)
+        """
+        root_key = _case_key(os.path.normpath(root_path)) if root_path else ''
+        for variant in expand_optional_sections(definition):
+            node = self._roots.setdefault(root_key, _Node())
+            components = [component for component in variant.split('/') if component]
+            for component in components:
+                key = _WILDCARD if '{' in component else _case_key(component)
+                node = node.children.setdefault(key, _Node())
+
+            suffix = ''
+            if components:
+                suffix = _case_key(components[-1].rsplit('}', 1)[-1])
+            node.templates.append((suffix, template))
+            self._size += 1
+
+    def _split(self, path):
+        """
+        Returns a (root key, path components relative to the root) tuple for
+        each root the passed path is under. Roots may be nested
+        """
+        path = os.path.normpath(path)
+        path_key = _case_key(path)
+        splits = []
+        for root_key in self._roots:
+            if not root_key:
+                relative_path = path
+            elif path_key == root_key or path_key.startswith(root_key.rstrip(os.sep) + os.sep):
+                relative_path = path[len(root_key):]
+            else:
+                continue
+            components = [component for component in relative_path.replace(os.sep, '/').split('/') if component]
+            splits.append((root_key, components))
+        return splits
+
+    def get_candidates(self, path):
+        """
+        Returns the templates that may match the passed path. Each candidate
+        is returned once, in indexing order
+        """
+        candidates = []
+        for (root_key, components) in self._split(path):
+            keys = [_case_key(component) for component in components]
+            last_key = keys[-1] if keys else ''
+
+            nodes = [self._roots[root_key]]
+            for key in keys:
+                next_nodes = []
+                for node in nodes:
+                    child = node.children.get(key)
+                    if child:
+                        next_nodes.append(child)
+                    child = node.children.get(_WILDCARD)
+                    if child:
+                        next_nodes.append(child)
+                nodes = next_nodes
+                if not nodes:
+                    break
+
+            for node in nodes:
+                for (suffix, template) in node.templates:
+                    if last_key.endswith(suffix) and template not in candidates:
+                        candidates.append(template)
+        return candidates
+
+_indexes = {}
+
+def get_template_index(tk):
+    """
+    Returns the index of the path templates of the passed toolkit API
+    instance, building it on first use
+    """
+    key = id(tk.templates)
+    index = _indexes.get(key)
+    if index is None:
+        from sgtk import TemplatePath
+
+        index = TemplateIndex()
+        for template in tk.templates.values():
+            if isinstance(template, TemplatePath):
+                index.add(template, template.root_path, template.definition)
+        _indexes[key] = index
+    return index
+
+def templates_from_path(tk, path):
+    """
+    Returns the templates matching the passed path. Same as
+    tk.templates_from_path, only testing the candidates found in the index
+    """
+    return [template for template in get_template_index(tk).get_candidates(path) if template.validate(path)]
+
+def template_from_path(tk, path):
+    """
+    Returns the template matching the passed path, or None. Same as
+    tk.template_from_path: raises TankMultipleMatchingTemplatesError if
+    several templates match
+    """
+    templates = templates_from_path(tk, path)
+    if not templates:
+        return None
+    if len(templates) > 1:
+        from sgtk import TankMultipleMatchingTemplatesError
+
+        raise TankMultipleMatchingTemplatesError(
+            '{} templates are matching the path "{}". The overlapping templates are: {}'.format(
+                len(templates), path, ', '.join(str(template) for template in templates)))
+    return templates[0]
+
+def get_template_and_fields(tk, path):
+    """
+    Returns the (template, fields) matching the passed path, or (None, None)
+    """
+    template = template_from_path(tk, path)
+    if not template:
+        return (None, None)
+    return (template, template.get_fields(path))
+
+################################################################################
+# Benchmark
+
+class _BenchmarkTemplate(object):
+    """
+    Simplified template, only used by the benchmark
+    """
+    def __init__(self, name, definition):
+        self.name = name
+        self.definition = definition
+        self._regexes = []
+        for variant in expand_optional_sections(definition):
+            regex = ''
+            for (index, part) in enumerate(re.split(r'({[^}]*})', variant)):
+                regex += '[^/]+' if index % 2 else re.escape(part)
+            self._regexes.append(re.compile('^' + regex + '$'))
+
+    def validate(self, path):
+        for regex in self._regexes:
+            if regex.match(path):
+                return True
+        return False
+
+def _load_benchmark_templates(templates_path):
+    try:
+        import yaml
+    except ImportError:
+        from tank_vendor import yaml
+    with open(templates_path) as f:
+        data = yaml.safe_load(f)
+
+    definitions = {}
+    for (name, value) in (data.get('paths') or {}).items():
+        definitions[name] = value.get('definition') if isinstance(value, dict) else value
+
+    def resolve(definition):
+        # Resolve @alias references to other path templates
+        if definition.startswith('@'):
+            (alias, _, rest) = definition[1:].partition('/')
+            resolved = resolve(definitions[alias])
+            return resolved + '/' + rest if rest else resolved
+        return definition
+
+    return [_BenchmarkTemplate(name, resolve(definition)) for (name, definition) in sorted(definitions.items())]
+
+def _make_path(template, random):
+    variant = random.choice(expand_optional_sections(template.definition))
+    return re.sub(r'{[^}]*}', lambda match: random.choice(['abc', 'hero', '012', 'v2']), variant)
+
+def _benchmark(templates_path, path_count):
+    import random
+    import time
+
+    random.seed(0)
+    templates = _load_benchmark_templates(templates_path)
+    paths = [_make_path(random.choice(templates), random) for _ in range(path_count)]
+    # Some paths do not match any template
+    for index in range(0, path_count, 10):
+        paths[index] = paths[index] + '.unknown'
+
+    start = time.time()
+    index = TemplateIndex()
+    for template in templates:
+        index.add(template, '', template.definition)
+    build_time = time.time() - start
+    print('{} templates ({} indexed variants), index built in {:.3f} ms'.format(len(templates), len(index), build_time * 1000))
+
+    start = time.time()
+    linear_results = [[template.name for template in templates if template.validate(path)] for path in paths]
+    linear_time = time.time() - start
+
+    start = time.time()
+    tested = 0
+    index_results = []
+    for path in paths:
+        candidates = index.get_candidates(path)
+        tested += len(candidates)
+        index_results.append([template.name for template in candidates if template.validate(path)])
+    index_time = time.time() - start
+
+    mismatches = sum(1 for (linear, indexed) in zip(linear_results, index_results) if sorted(linear) != sorted(indexed))
+    print('{} paths'.format(path_count))
+    print('  linear: {:.3f} s, {} templates tested per path'.format(linear_time, len(templates)))
+    print('  index : {:.3f} s, {:.2f} templates tested per path'.format(index_time, float(tested) / path_count))
+    print('  mismatches: {}'.format(mismatches))
+    return 1 if mismatches else 0
+
+def _main(argv):
+    import argparse
+
+    default_templates = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                      os.pardir, os.pardir, 'core', 'templates.yml'))
+
+    parser = argparse.ArgumentParser(description='Benchmark the template index')
+    parser.add_argument('--benchmark', action='store_true', required=True)
+    parser.add_argument('--paths', type=int, default=100000)
+    parser.add_argument('--templates', default=default_templates)
+    args = parser.parse_args(argv)
+
+    return _benchmark(args.templates, args.paths)
+
+if __name__ == '__main__':
+    sys.exit(_main(sys.argv[1:]))
@@ -0,0 +1,312 @@
+"""
+Running Unity editors
+
+Unity refuses to open a project that is already open in another editor
+(Temp/UnityLockfile). When launching from a Note or a Version whose project
+is already open, the launch request (scene and frame) is delivered to the
+running editor instead of starting a new one.
+
+- app_launch.py registers the pid of each editor it launches, per project
+- apply_metadata.py starts a launch request server in the editor and
+  registers its port, per project
+- before_app_launch.py looks for a running editor for the target project,
+  and app_launch.py delivers the launch request to it
+
+The registry is a json file under the Shotgun cache location. The launch
+request server only listens on the loopback interface, and requests must
+carry the random token stored in the registry.
+"""
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import uuid
+
+import sgtk
+
+import unity_metadata
+
+log = sgtk.LogManager.get_logger(__name__)
+
+# Environment variable in which before_app_launch.py passes the running
+# editor entry to app_launch.py
+RUNNING_EDITOR_ENV_VAR = 'SHOTGUN_UNITY_RUNNING_EDITOR'
+
+CONNECT_TIMEOUT = 2 # seconds
+
+# An editor launched longer ago than this without starting its launch request
+# server is not considered starting anymore (e.g. it crashed, leaving its
+# lockfile behind)
+STARTING_TIMEOUT = 300 # seconds
+
+_registry_lock = threading.Lock()
+
+def get_registry_path():
+    from sgtk.util import LocalFileStorageManager
+
+    cache_root = LocalFileStorageManager.get_global_root(LocalFileStorageManager.CACHE)
+    return os.path.join(cache_root, 'unity', 'editors.json')
+
+def _read_registry(registry_path):
+    try:
+        with open(registry_path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+def _update_registry(project_path, values, registry_path=None):
+    """
+    Updates the registry entry of the passed project with the passed values.
+    None values are removed from the entry
+    """
+    registry_path = registry_path or get_registry_path()
+    key = unity_metadata.canonical_path(project_path)
+    with _registry_lock:
+        registry = _read_registry(registry_path)
+        entry = registry.setdefault(key, {})
+        entry.update(values)
+        for name in [name for (name, value) in entry.items() if value is None]:
+            del entry[name]
+        if not entry:
+            del registry[key]
+
+        registry_folder = os.path.dirname(registry_path)
+        if not os.path.isdir(registry_folder):
+            os.makedirs(registry_folder)
+
+        # The registry holds the tokens: keep it readable by the user only
+        temp_path = '{}.{}.tmp'.format(registry_path, os.getpid())
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(registry, f)
+        if sys.platform == 'win32' and os.path.exists(registry_path):
+            os.remove(registry_path)
+        os.rename(temp_path, registry_path)
+
+def register_launched_editor(project_path, pid, registry_path=None):
+    """
+    Records the pid of an editor launched for the passed project
+    """
+    _update_registry(project_path, { 'pid': pid, 'launch_time': time.time() }, registry_path)
+
+def _is_process_alive(pid):
+    if not pid:
+        return False
+
+    if sys.platform == 'win32':
+        import ctypes
+        PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+        STILL_ACTIVE = 259
+        handle = ctypes.windll.kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+        if not handle:
+            return False
+        try:
+            exit_code = ctypes.c_ulong()
+            ctypes.windll.kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code))
+            return exit_code.value == STILL_ACTIVE
+        finally:
+            ctypes.windll.kernel32.CloseHandle(handle)
+
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        # EPERM means the process exists but belongs to someone else
+        return e.errno == 1
+    return True
+
+def _get_process_name(pid):
+    """
+    Returns the executable name of the passed process, or None if it cannot
+    be determined
+    """
+    if sys.platform == 'win32':
+        import ctypes
+        PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+        handle = ctypes.windll.kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+        if not handle:
+            return None
+        try:
+            buffer = ctypes.create_unicode_buffer(1024)
+            size = ctypes.c_ulong(len(buffer))
+            if not ctypes.windll.kernel32.QueryFullProcessImageNameW(handle, 0, buffer, ctypes.byref(size)):
+                return None
+            return os.path.basename(buffer.value)
+        finally:
+            ctypes.windll.kernel32.CloseHandle(handle)
+
+    if sys.platform.startswith('linux'):
+        try:
+            return os.path.basename(os.readlink('/proc/{}/exe'.format(pid)))
+        except OSError:
+            try:
+                with open('/proc/{}/comm'.format(pid)) as f:
+                    return f.read().strip()
+            except (IOError, OSError):
+                return None
+
+    import subprocess
+    try:
+        output = subprocess.check_output(['ps', '-p', str(pid), '-o', 'comm='])
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return os.path.basename(output.decode('utf-8', 'replace').strip()) or None
+
+def _is_starting_editor(entry):
+    """
+    Returns True if the pid of the passed registry entry is a Unity editor
+    launched less than STARTING_TIMEOUT seconds ago. The pid may have been
+    reused by another process since, and on macOS the registered pid is the
+    one of the "open" command, not of the editor
+    """
+    pid = entry.get('pid')
+    if time.time() - entry.get('launch_time', 0) > STARTING_TIMEOUT:
+        return False
+    if not _is_process_alive(pid):
+        return False
+    name = _get_process_name(pid)
+    return bool(name) and 'unity' in name.lower()
+
+def _send(entry, message):
+    """
+    Sends a message to the launch request server of the passed registry entry.
+    Returns the response, or None if the server could not be reached
+    """
+    message = dict(message)
+    message['token'] = entry.get('token')
+    try:
+        connection = socket.create_connection(('127.0.0.1', entry['port']), CONNECT_TIMEOUT)
+    except (socket.error, KeyError, TypeError):
+        return None
+
+    try:
+        connection.settimeout(CONNECT_TIMEOUT)
+        connection.sendall((json.dumps(message) + '\n').encode('utf-8'))
+        response = connection.makefile('rb').readline()
+        return json.loads(response.decode('utf-8'))
+    except (socket.error, ValueError):
+        return None
+    finally:
+        connection.close()
+
+def find_running_editor(project_path, registry_path=None):
+    """
+    Returns the registry entry of the editor that has the passed project
+    open, or None
+
+    The entry has a 'status' key: 'running' if the editor accepts launch
+    requests, 'starting' if an editor launched by app_launch.py is still
+    starting (its launch request server is not up yet, see 
+    _is_starting_editor)
+    """
+    lockfile = os.path.join(project_path, 'Temp', 'UnityLockfile')
+    if not os.path.exists(lockfile):
+        return None
+
+    registry_path = registry_path or get_registry_path()
+    with _registry_lock:
+        entry = _read_registry(registry_path).get(unity_metadata.canonical_path(project_path))
+    if not entry:
+        return None
+
+    if entry.get('port'):
+        response = _send(entry, { 'command': 'ping' })
+        if response and response.get('status') == 'ok':
+            entry['status'] = 'running'
+            return entry
+
+    if _is_starting_editor(entry):
+        entry['status'] = 'starting'
+        return entry
+
+    return None
+
+def send_launch_request(entry, launch_context):
+    """
+    Delivers a launch context (see unity_metadata.write_launch_context) to
+    the running editor of the passed registry entry. Returns True on success
+    """
+    response = _send(entry, { 'command': 'launch', 'launch_context': launch_context })
+    if not response or response.get('status') != 'ok':
+        log.debug('The running Unity editor did not accept the launch request: {}'.format(response))
+        return False
+    return True
+
+class LaunchRequestServer(object):
+    """
+    Listens on the loopback interface for launch requests sent by the
+    launcher (see send_launch_request). handler is called with the launch
+    context of each request, in the server thread
+    """
+    def __init__(self, project_path, handler, registry_path=None):
+        self._project_path = project_path
+        self._handler = handler
+        self._registry_path = registry_path
+        self._token = uuid.uuid4().hex
+        self._socket = None
+
+    @property
+    def port(self):
+        return self._socket.getsockname()[1] if self._socket else None
+
+    def start(self):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.bind(('127.0.0.1', 0))
+        self._socket.listen(5)
+
+        thread = threading.Thread(target=self._serve, name='UnityLaunchRequestServer')
+        thread.daemon = True
+        thread.start()
+
+        _update_registry(self._project_path, { 'port': self.port, 'token': self._token }, self._registry_path)
+
+    def stop(self):
+        if not self._socket:
+            return
+        _update_registry(self._project_path, { 'port': None, 'token': None }, self._registry_path)
+        self._socket.close()
+        self._socket = None
+
+    def _serve(self):
+        while self._socket:
+            try:
+                connection, _ = self._socket.accept()
+            except (socket.error, AttributeError):
+                # Stopped
+                return
+            try:
+                self._serve_connection(connection)
+            except Exception as e:
+                log.debug('Error while serving a launch request: {}'.format(e))
+            finally:
+                connection.close()
+
+    def _serve_connection(self, connection):
+        connection.settimeout(CONNECT_TIMEOUT)
+        message = json.loads(connection.makefile('rb').readline().decode('utf-8'))
+        if message.get('token') != self._token:
+            response = { 'status': 'error', 'error': 'invalid token' }
+        elif message.get('command') == 'ping':
+            response = { 'status': 'ok' }
+        elif message.get('command') == 'launch':
+            self._handler(message.get('launch_context') or {})
+            response = { 'status': 'ok' }
+        else:
+            response = { 'status': 'error', 'error': 'unknown command' }
+        connection.sendall((json.dumps(response) + '\n').encode('utf-8'))
+
+_launch_request_server = None
+
+def start_launch_request_server(project_path, handler):
+    """
+    Starts the launch request server of this editor, replacing the previous
+    one if any (e.g. when the engine is restarted)
+    """
+    global _launch_request_server
+    if _launch_request_server:
+        _launch_request_server.stop()
+
+    _launch_request_server = LaunchRequestServer(project_path, handler)
+    _launch_request_server.start()
+    return _launch_request_server
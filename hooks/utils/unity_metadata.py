@@ -1,15 +1,76 @@
 import sgtk
 
+import launch_trace
+
+import copy
 import json
 import os
+import sys
+import tempfile
+import threading
+import time
 
 log = sgtk.LogManager.get_logger(__name__)
 
-def _get_frame_from_note(note_entity, sg):
-    #   'attachments': [{'type': 'Attachment', 'id': 1668, 'name': 'annot_version_7199.107.png'}], 
-    entity = sg.find_one(note_entity["type"], [["id", "is", note_entity["id"]]], ["attachments"])
+# Schema reads are among the slowest Shotgun API calls. Since this module is
+# imported once per process and shared by all the hooks (launcher, tk-unity 
+# bootstrap, Shotgun panel), we keep the entity schemas we read here.
+# Keys are (site url, entity type), values are (read time, fields)
+SCHEMA_CACHE_TTL = 300 # seconds
+_schema_cache = {}
+_schema_cache_stats = { 'hits': 0, 'misses': 0 }
+_schema_cache_lock = threading.Lock()
+
+def _get_site_key(sg):
+    return getattr(sg, 'base_url', None)
+
+@launch_trace.traced('unity_metadata.get_entity_schema')
+def get_entity_schema(entity_type, sg):
+    """
+    Returns the field schema of the passed entity type, as returned by 
+    sg.schema_field_read
     
-    attachments = entity.get("attachments", None)
+    Schemas are cached per site and entity type for SCHEMA_CACHE_TTL seconds
+    """
+    key = (_get_site_key(sg), entity_type)
+    now = time.time()
+    with _schema_cache_lock:
+        cached = _schema_cache.get(key)
+        if cached and now - cached[0] < SCHEMA_CACHE_TTL:
+            _schema_cache_stats['hits'] += 1
+            return cached[1]
+        _schema_cache_stats['misses'] += 1
+
+    fields = sg.schema_field_read(entity_type)
+    with _schema_cache_lock:
+        _schema_cache[key] = (now, fields)
+    return fields
+
+def invalidate_schema_cache(entity_type=None, sg=None):
+    """
+    Removes cached schemas. If an entity type and/or a Shotgun connection are 
+    passed, only the matching entries are removed
+    """
+    site_key = _get_site_key(sg) if sg else None
+    with _schema_cache_lock:
+        for key in list(_schema_cache.keys()):
+            if entity_type and key[1] != entity_type:
+                continue
+            if sg and key[0] != site_key:
+                continue
+            del _schema_cache[key]
+
+def get_schema_cache_stats():
+    """
+    Returns a dictionary with the number of schema cache hits and misses
+    """
+    with _schema_cache_lock:
+        stats = dict(_schema_cache_stats)
+        stats['size'] = len(_schema_cache)
+    return stats
+
+def _get_frame_from_attachments(attachments):
+    #   'attachments': [{'type': 'Attachment', 'id': 1668, 'name': 'annot_version_7199.107.png'}], 
     if not attachments:
         return None
         
@@ -19,6 +80,110 @@ def _get_frame_from_note(note_entity, sg):
         return None
     return tokens[1] # frame number
 
+def _get_version_from_links(note_links):
+    for link in note_links or []:
+        if link['type'] == 'Version':
+            return link
+    return None
+
+def _parse_metadata(metadata_json):
+    metadata = {}
+    if metadata_json:
+        try:
+            metadata = json.loads(metadata_json)
+        except:
+            pass
+    return metadata
+
+@launch_trace.traced('unity_metadata.get_metadata_for_entities')
+def get_metadata_for_entities(entities, sg, validators=None):
+    """
+    Batched version of get_metadata_from_entity
+    
+    Resolves the metadata of all the passed entities with one sg.find call per
+    entity type (plus one for the Versions linked to Notes), instead of 
+    traversing each entity individually
+    
+    If a validators dictionary is passed, it is filled with the 
+    [entity type, entity id, updated_at] lists of the entities the metadata 
+    of each entity was read from. This is used to validate cached metadata 
+    (see unity_metadata_cache)
+    
+    Returns a dictionary keyed by (entity type, entity id). The values are the 
+    same as what get_metadata_from_entity would return for that entity
+    """
+    results = {}
+    if not entities or not sg:
+        return results
+    
+    ids_by_type = {}
+    for entity in entities:
+        if not entity or not entity.get('type') or not entity.get('id'):
+            continue
+        ids_by_type.setdefault(entity['type'], set()).add(entity['id'])
+    
+    # Notes without metadata of their own. Values are (version, frame number)
+    note_versions = {}
+    for entity_type, ids in ids_by_type.items():
+        fields = []
+        if get_entity_schema(entity_type, sg).get('sg_unity_metadata'):
+            fields.append('sg_unity_metadata')
+        if entity_type == 'Note':
+            fields.extend(['note_links', 'attachments'])
+        
+        if not fields:
+            for entity_id in ids:
+                results[(entity_type, entity_id)] = {}
+            continue
+        
+        if validators is not None:
+            fields.append('updated_at')
+        
+        found_entities = sg.find(entity_type, [['id', 'in', list(ids)]], fields)
+        for found_entity in found_entities:
+            key = (entity_type, found_entity['id'])
+            if validators is not None:
+                validators[key] = [[entity_type, found_entity['id'], str(found_entity.get('updated_at'))]]
+            
+            metadata_json = found_entity.get('sg_unity_metadata')
+            if metadata_json or entity_type != 'Note':
+                results[key] = _parse_metadata(metadata_json)
+                continue
+            
+            # If the note is linked to a Version entity, get the metadata 
+            # from that Version entity
+            version = _get_version_from_links(found_entity.get('note_links'))
+            if not version:
+                results[key] = None
+                continue
+            
+            frame_number = _get_frame_from_attachments(found_entity.get('attachments'))
+            note_versions[found_entity['id']] = (version, frame_number)
+    
+    if note_versions:
+        # Only query the Versions that were not part of this batch
+        versions = [version for (version, _) in note_versions.values()
+                    if (version['type'], version['id']) not in results]
+        versions_validators = {} if validators is not None else None
+        versions_metadata = get_metadata_for_entities(versions, sg, versions_validators)
+        versions_metadata.update(results)
+        for note_id, (version, frame_number) in note_versions.items():
+            version_key = (version['type'], version['id'])
+            if validators is not None:
+                version_validators = validators.get(version_key) or versions_validators.get(version_key, [])
+                validators[('Note', note_id)] = validators[('Note', note_id)] + version_validators
+            
+            metadata = copy.deepcopy(versions_metadata.get(version_key))
+            if metadata is None:
+                metadata = {}
+            
+            # Add the note frame number to the metadata
+            if frame_number:
+                metadata['frame_number'] = frame_number
+            results[('Note', note_id)] = metadata
+    
+    return results
+
 def get_metadata_from_entity(entity, sg):
     """
     From a given entity, find the best metadata dictionary to use
@@ -34,73 +199,252 @@ def get_metadata_from_entity(entity, sg):
     if not entity or not entity.get('type') or not entity.get('id') or not sg:
         return None
     
-    metadata_json = None
-    metadata = {}
-    fields = sg.schema_field_read(entity['type'])
-
-    if fields.get('sg_unity_metadata'):
-        # The field exists on the current entity. Get its value
-        found_entity = sg.find_one(entity['type'], [['id', 'is', entity['id']]], ['sg_unity_metadata'])
-        metadata_json = found_entity['sg_unity_metadata'] 
-
-    if not metadata_json:
-        # We did not find metadata on the entity. Try to look at its 
-        # dependencies
-        if entity['type'] == 'Note':
-            # If the note is linked to a Version entity, try to get the metadata 
-            # from that Version entity
-            version = get_version_from_note(entity, sg)
-            if not version:
-                return None
-            
-            metadata = get_metadata_from_entity(version, sg)
-                    
-            # Add the note frame number to the metadata
-            frame_number = _get_frame_from_note(entity, sg)
-            if frame_number:
-                metadata['frame_number'] = frame_number
-            
-            return metadata
-            
-    if metadata_json:
+    # For a Note, the note metadata, links and attachments are fetched in a 
+    # single query, followed by a single query on the linked Version
+    results = get_metadata_for_entities([entity], sg)
+    return results.get((entity['type'], entity['id']))
+
+# The loaded project cannot change without a domain reload, so its canonical
+# path is computed once per engine session
+_loaded_project = None
+
+# Canonical forms of the metadata project paths we compared. Bounded since
+# the panel may go through many different paths
+_CANONICAL_PATHS_MAX_SIZE = 256
+_canonical_paths = {}
+
+def canonical_path(path):
+    """
+    Returns a form of the passed path suitable for comparisons: symlinks are 
+    resolved, separators and case are normalized for the current platform
+    """
+    canonical = _canonical_paths.get(path)
+    if canonical is None:
+        canonical = os.path.realpath(path)
+        canonical = os.path.normcase(os.path.normpath(canonical))
+        if sys.platform == 'darwin':
+            # The default macOS file system is case-insensitive
+            canonical = canonical.lower()
+        
+        if len(_canonical_paths) >= _CANONICAL_PATHS_MAX_SIZE:
+            _canonical_paths.clear()
+        _canonical_paths[path] = canonical
+    return canonical
+
+@launch_trace.traced('unity_metadata.get_loaded_project')
+def get_loaded_project():
+    """
+    Returns the canonical path of the Unity project currently loaded
+    """
+    global _loaded_project
+    if _loaded_project is None:
+        from sg_client import GetUnityEngine
+        
+        # Remove /Assets
+        launch_trace.count_bridge_calls()
+        loaded_project = GetUnityEngine().Application.dataPath
+        loaded_project = os.path.split(loaded_project)[0]
+        _loaded_project = canonical_path(loaded_project)
+    return _loaded_project
+
+def invalidate_loaded_project():
+    """
+    Forgets the loaded project path, e.g. after a domain reload
+    """
+    global _loaded_project
+    _loaded_project = None
+
+@launch_trace.traced('unity_metadata.get_cached_metadata_from_entity')
+def get_cached_metadata_from_entity(entity, sg):
+    """
+    Same as get_metadata_from_entity, but goes through the persistent local 
+    metadata cache (see unity_metadata_cache). Used when launching, where 
+    avoiding the Shotgun traversal matters most and where cached metadata 
+    allows opening the right project and scene when the site is unreachable
+    """
+    import unity_metadata_cache
+    
+    if not entity or not entity.get('type') or not entity.get('id') or not sg:
+        return None
+    
+    return unity_metadata_cache.get_metadata(entity, sg)
+
+@launch_trace.traced('unity_metadata.get_cached_launch_metadata')
+def get_cached_launch_metadata(entity, sg, resolve_context_entity):
+    """
+    Same as get_cached_metadata_from_entity, but returns (metadata, context 
+    entity). The context entity of the launch is resolved with 
+    resolve_context_entity(entity, sg), and cached along with the metadata
+    """
+    import unity_metadata_cache
+    
+    if not entity or not entity.get('type') or not entity.get('id') or not sg:
+        return (None, None)
+    
+    return unity_metadata_cache.get_launch_metadata(entity, sg, resolve_context_entity)
+
+# The launcher hands the metadata it resolved to tk-unity through a launch 
+# context file, so that the engine does not query Shotgun again on startup.
+# The path of the file is passed in this environment variable. The file is
+# deleted by its consumer (tk-unity, or the launcher when it delivers a launch
+# request), and by the launcher once stale in case it was never consumed
+LAUNCH_CONTEXT_ENV_VAR = 'SHOTGUN_UNITY_LAUNCH_CONTEXT'
+LAUNCH_CONTEXT_MAX_AGE = 600 # seconds
+_LAUNCH_CONTEXT_PREFIX = 'tk-unity-launch-'
+_LAUNCH_CONTEXT_SUFFIX = '.json'
+
+def write_launch_context(launch_entity, metadata, context_entity=None):
+    """
+    Writes the metadata resolved for the launch entity to a launch context 
+    file and stores its path in the LAUNCH_CONTEXT_ENV_VAR environment 
+    variable, for the launched process to read (see read_launch_context)
+    
+    context_entity is the entity (or task) the context was switched to, if any.
+    Only written when the metadata lookup succeeded: None metadata means that
+    the launch entity has no metadata
+    """
+    launch_context = { 'launch_entity'  : { 'type': launch_entity['type'], 'id': launch_entity['id'] },
+                       'context_entity' : context_entity,
+                       'metadata'       : metadata,
+                       'time'           : time.time() }
+
+    (fd, path) = tempfile.mkstemp(prefix=_LAUNCH_CONTEXT_PREFIX, suffix=_LAUNCH_CONTEXT_SUFFIX)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(launch_context, f)
+    os.environ[LAUNCH_CONTEXT_ENV_VAR] = path
+    return path
+
+def read_launch_context(launch_entity):
+    """
+    Returns the launch context written by the launcher for the passed launch
+    entity, or None if there is no launch context file, or if it is stale 
+    (older than LAUNCH_CONTEXT_MAX_AGE seconds, or for another entity)
+    """
+    path = os.environ.get(LAUNCH_CONTEXT_ENV_VAR)
+    if not path or not os.path.isfile(path):
+        return None
+    
+    try:
+        with open(path) as f:
+            launch_context = json.load(f)
+    except Exception as e:
+        log.debug('Could not read the launch context file "{}": {}'.format(path, e))
+        return None
+    
+    if time.time() - launch_context.get('time', 0) > LAUNCH_CONTEXT_MAX_AGE:
+        return None
+    
+    entity = launch_context.get('launch_entity') or {}
+    if entity.get('type') != launch_entity.get('type') or entity.get('id') != launch_entity.get('id'):
+        return None
+    
+    return launch_context
+
+def remove_launch_context():
+    """
+    Deletes the launch context file passed in the LAUNCH_CONTEXT_ENV_VAR 
+    environment variable, once consumed
+    """
+    path = os.environ.get(LAUNCH_CONTEXT_ENV_VAR)
+    if not path or not os.path.basename(path).startswith(_LAUNCH_CONTEXT_PREFIX):
+        return
+    try:
+        os.remove(path)
+    except OSError as e:
+        log.debug('Could not remove the launch context file "{}": {}'.format(path, e))
+
+def remove_stale_launch_contexts():
+    """
+    Deletes the launch context files which were never consumed (e.g. the 
+    launch failed) and are too old to be used anyway
+    """
+    folder = tempfile.gettempdir()
+    now = time.time()
+    try:
+        names = os.listdir(folder)
+    except OSError:
+        return
+    for name in names:
+        if not name.startswith(_LAUNCH_CONTEXT_PREFIX) or not name.endswith(_LAUNCH_CONTEXT_SUFFIX):
+            continue
+        path = os.path.join(folder, name)
         try:
-            metadata = json.loads(metadata_json)
-        except:
-            pass
-            
-    return metadata
+            if now - os.path.getmtime(path) > LAUNCH_CONTEXT_MAX_AGE:
+                os.remove(path)
+        except OSError as e:
+            log.debug('Could not remove the stale launch context file "{}": {}'.format(path, e))
 
 def relates_to_current_project(metadata):
-    from sg_client import GetUnityEngine
-
     # Make sure the right project is currently loaded
-    loaded_project = GetUnityEngine().Application.dataPath
+    metadata_project = metadata.get('project_path')
+    if not metadata_project:
+        return False
+    
+    return canonical_path(metadata_project) == get_loaded_project()
 
-    # Remove /Assets
-    loaded_project = os.path.split(loaded_project)[0]
-    loaded_project = os.path.normpath(loaded_project)
+# Paths of the scenes in the loaded Unity project. Building the index crosses
+# the Python/C# bridge once per scene, so it is built once and invalidated 
+# when the project assets change (EditorApplication.projectChanged). The TTL
+# is a safety net in case the event subscription is not available
+SCENE_INDEX_TTL = 60 # seconds
+_scene_index = None
+_scene_index_time = 0
+_scene_index_subscribed = False
+_scene_index_lock = threading.Lock()
 
-    metadata_project = metadata.get('project_path')
-    metadata_project = os.path.normpath(metadata_project)
+def invalidate_scene_index(*args):
+    """
+    Discards the scene path index. It is rebuilt on next use
     
-    return metadata_project == loaded_project
+    Also used as the EditorApplication.projectChanged handler, hence the 
+    unused arguments
+    """
+    global _scene_index
+    with _scene_index_lock:
+        _scene_index = None
 
-def relates_to_existing_scene(metadata):
+def _subscribe_scene_index_invalidation(UnityEditor):
+    global _scene_index_subscribed
+    if _scene_index_subscribed:
+        return
+    _scene_index_subscribed = True
+    try:
+        # Imports, moves and deletions all raise projectChanged
+        UnityEditor.EditorApplication.projectChanged += invalidate_scene_index
+    except Exception as e:
+        log.debug('Could not subscribe to EditorApplication.projectChanged, the scene index will expire after {} seconds: {}'.format(SCENE_INDEX_TTL, e))
+
+@launch_trace.traced('unity_metadata.get_scene_index')
+def get_scene_index():
+    """
+    Returns the set of scene paths (e.g. "Assets/Scenes/main.unity") in the 
+    currently loaded Unity project
+    """
+    global _scene_index, _scene_index_time
     from sg_client import GetUnityEditor
     
-    metadata_scene_path = metadata.get('scene_path')
-    if not metadata_scene_path:
-        return False
+    with _scene_index_lock:
+        if _scene_index is not None and time.time() - _scene_index_time < SCENE_INDEX_TTL:
+            return _scene_index
     
     UnityEditor = GetUnityEditor()
+    _subscribe_scene_index_invalidation(UnityEditor)
     
     scene_guids = UnityEditor.AssetDatabase.FindAssets('t:scene')
-    for guid in scene_guids:
-        scene_path = UnityEditor.AssetDatabase.GUIDToAssetPath(guid)
-        if scene_path == metadata_scene_path:
-            return True
+    scene_index = set(UnityEditor.AssetDatabase.GUIDToAssetPath(guid) for guid in scene_guids)
+    launch_trace.count_bridge_calls(1 + len(scene_guids))
+    
+    with _scene_index_lock:
+        _scene_index = scene_index
+        _scene_index_time = time.time()
+    return scene_index
 
-    return False
+def relates_to_existing_scene(metadata):
+    metadata_scene_path = metadata.get('scene_path')
+    if not metadata_scene_path:
+        return False
+    
+    return metadata_scene_path in get_scene_index()
 
 def get_version_from_note(note, sg):
     """
@@ -108,10 +452,5 @@ def get_version_from_note(note, sg):
     """
     # Retrieve the note links
     found_entity = sg.find_one(note['type'], [['id', 'is', note['id']]], ['note_links'])
-    note_links = found_entity['note_links']
-    for link in note_links:
-        if link['type'] == 'Version':
-            return link
-        
-    return None
+    return _get_version_from_links(found_entity['note_links'])
     
\ No newline at end of file
@@ -0,0 +1,288 @@
+"""
+Persistent local cache for Unity metadata
+
+Launching Unity from a Note or a Version (before_app_launch.py) and
+bootstrapping tk-unity (apply_metadata.py) both resolve sg_unity_metadata.
+The resolved metadata is stored in a SQLite database under the Shotgun cache
+location, keyed by site and entity, along with the updated_at values of the
+entities it was read from.
+
+- Entries stored less than TRUST_SECONDS ago are used without any network call
+- Older entries are validated with a single lightweight updated_at query per
+  entity type
+- If the site cannot be reached, the cached metadata is used as is
+
+The launcher also stores the context entity of the launch (the entity or task
+a Note or Version launch switches the context to, see before_app_launch.py)
+next to the metadata. It is validated and refreshed along with the metadata.
+
+The cache holds at most MAX_ENTRIES entries, the least recently used ones are
+evicted first.
+
+The cache can be inspected or purged from the command line:
+
+    python unity_metadata_cache.py [--db PATH] {info,list,purge}
+
+--db is required when sgtk cannot be imported, e.g. outside of the Python of
+a Toolkit installation.
+"""
+import json
+import os
+import sqlite3
+import sys
+import time
+
+MAX_ENTRIES = 2000
+TRUST_SECONDS = 120
+
+_DB_FILE_NAME = 'unity_metadata.sqlite'
+
+def _get_logger():
+    import sgtk
+    return sgtk.LogManager.get_logger(__name__)
+
+def get_cache_path():
+    """
+    Returns the path of the cache database, under the Shotgun cache location
+    """
+    from sgtk.util import LocalFileStorageManager
+
+    cache_root = LocalFileStorageManager.get_global_root(LocalFileStorageManager.CACHE)
+    return os.path.join(cache_root, 'unity', _DB_FILE_NAME)
+
+def _connect(db_path=None):
+    db_path = db_path or get_cache_path()
+    db_folder = os.path.dirname(db_path)
+    if not os.path.isdir(db_folder):
+        os.makedirs(db_folder)
+
+    connection = sqlite3.connect(db_path, timeout=5)
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS metadata ('
+        ' site TEXT NOT NULL,'
+        ' entity_type TEXT NOT NULL,'
+        ' entity_id INTEGER NOT NULL,'
+        ' metadata TEXT,'
+        ' validators TEXT NOT NULL,'
+        ' stored_at REAL NOT NULL,'
+        ' last_access REAL NOT NULL,'
+        ' context_entity TEXT,'
+        ' PRIMARY KEY (site, entity_type, entity_id))')
+
+    # Caches created before the context entities were stored
+    columns = [row[1] for row in connection.execute('PRAGMA table_info(metadata)')]
+    if 'context_entity' not in columns:
+        with connection:
+            connection.execute('ALTER TABLE metadata ADD COLUMN context_entity TEXT')
+    return connection
+
+def _load_context_entity(value):
+    # NULL when the context entity was not resolved, 'null' when there is none
+    return (False, None) if value is None else (True, json.loads(value))
+
+def lookup(site, entity_type, entity_id, db_path=None):
+    """
+    Returns the cached entry for the passed entity as a
+    (metadata, validators, stored_at, (resolved, context entity)) tuple, or
+    None
+    """
+    connection = _connect(db_path)
+    try:
+        with connection:
+            row = connection.execute(
+                'SELECT metadata, validators, stored_at, context_entity FROM metadata '
+                'WHERE site = ? AND entity_type = ? AND entity_id = ?',
+                (site, entity_type, entity_id)).fetchone()
+            if not row:
+                return None
+
+            connection.execute(
+                'UPDATE metadata SET last_access = ? '
+                'WHERE site = ? AND entity_type = ? AND entity_id = ?',
+                (time.time(), site, entity_type, entity_id))
+    finally:
+        connection.close()
+
+    return (json.loads(row[0]), json.loads(row[1]), row[2], _load_context_entity(row[3]))
+
+def store(site, entity_type, entity_id, metadata, validators, context_entity=(False, None), db_path=None):
+    """
+    Stores the metadata of the passed entity, evicting the least recently
+    used entries if the cache holds more than MAX_ENTRIES entries
+
+    context_entity is a (resolved, context entity) tuple
+    """
+    (context_resolved, context_entity) = context_entity
+    now = time.time()
+    connection = _connect(db_path)
+    try:
+        with connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (site, entity_type, entity_id, json.dumps(metadata),
+                 json.dumps(validators), now, now,
+                 json.dumps(context_entity) if context_resolved else None))
+            connection.execute(
+                'DELETE FROM metadata WHERE rowid IN ('
+                ' SELECT rowid FROM metadata ORDER BY last_access DESC'
+                ' LIMIT -1 OFFSET ?)', (MAX_ENTRIES,))
+    finally:
+        connection.close()
+
+def purge(db_path=None):
+    """
+    Removes all the entries. Returns the number of removed entries
+    """
+    connection = _connect(db_path)
+    try:
+        with connection:
+            return connection.execute('DELETE FROM metadata').rowcount
+    finally:
+        connection.close()
+
+def entries(db_path=None):
+    """
+    Returns the cached entries as a list of dictionaries, most recently used
+    first
+    """
+    connection = _connect(db_path)
+    try:
+        rows = connection.execute(
+            'SELECT site, entity_type, entity_id, metadata, stored_at, last_access '
+            'FROM metadata ORDER BY last_access DESC').fetchall()
+    finally:
+        connection.close()
+
+    return [ { 'site'        : row[0],
+               'entity_type' : row[1],
+               'entity_id'   : row[2],
+               'metadata'    : json.loads(row[3]),
+               'stored_at'   : row[4],
+               'last_access' : row[5] } for row in rows ]
+
+def _read_validators(validators, sg):
+    """
+    Returns the current [entity type, entity id, updated_at] lists for the
+    entities in the passed validators
+    """
+    ids_by_type = {}
+    for (entity_type, entity_id, _) in validators:
+        ids_by_type.setdefault(entity_type, []).append(entity_id)
+
+    updated_at = {}
+    for entity_type, ids in ids_by_type.items():
+        for found_entity in sg.find(entity_type, [['id', 'in', ids]], ['updated_at']):
+            updated_at[(entity_type, found_entity['id'])] = str(found_entity.get('updated_at'))
+
+    return [ [entity_type, entity_id, updated_at.get((entity_type, entity_id))]
+             for (entity_type, entity_id, _) in validators ]
+
+def get_metadata(entity, sg, db_path=None):
+    """
+    Returns the metadata of the passed entity (see
+    unity_metadata.get_metadata_from_entity), going through the cache
+    """
+    return get_launch_metadata(entity, sg, None, db_path)[0]
+
+def get_launch_metadata(entity, sg, resolve_context_entity, db_path=None):
+    """
+    Returns (metadata, context entity) for the passed launch entity, going
+    through the cache. The context entity is resolved with
+    resolve_context_entity(entity, sg) when it is not cached, or is None if
+    no resolve function is passed
+    """
+    import unity_metadata
+
+    log = _get_logger()
+    site = getattr(sg, 'base_url', None)
+    entity_type = entity['type']
+    entity_id = entity['id']
+
+    def get_context_entity(metadata, validators, cached_context_entity):
+        (resolved, context_entity) = cached_context_entity
+        if resolved or not resolve_context_entity:
+            return context_entity
+        context_entity = resolve_context_entity(entity, sg)
+        try:
+            store(site, entity_type, entity_id, metadata, validators, (True, context_entity), db_path)
+        except Exception as e:
+            log.debug('Could not write the local Unity metadata cache: {}'.format(e))
+        return context_entity
+
+    entry = None
+    try:
+        entry = lookup(site, entity_type, entity_id, db_path)
+    except Exception as e:
+        log.debug('Could not read the local Unity metadata cache: {}'.format(e))
+
+    if entry:
+        (metadata, validators, stored_at, cached_context_entity) = entry
+        try:
+            if time.time() - stored_at < TRUST_SECONDS:
+                return (metadata, get_context_entity(metadata, validators, cached_context_entity))
+
+            current_validators = _read_validators(validators, sg)
+            if current_validators == validators:
+                # Still valid, restart the trust period
+                try:
+                    store(site, entity_type, entity_id, metadata, validators, cached_context_entity, db_path)
+                except Exception as e:
+                    log.debug('Could not write the local Unity metadata cache: {}'.format(e))
+                return (metadata, get_context_entity(metadata, validators, cached_context_entity))
+        except Exception as e:
+            log.warning('Could not validate the cached Unity metadata for {} {} ({}). Using the cached metadata.'.format(entity_type, entity_id, e))
+            return (metadata, cached_context_entity[1])
+
+    validators = {}
+    key = (entity_type, entity_id)
+    try:
+        results = unity_metadata.get_metadata_for_entities([entity], sg, validators)
+        metadata = results.get(key)
+        context_entity = resolve_context_entity(entity, sg) if resolve_context_entity else None
+    except Exception as e:
+        if entry:
+            log.warning('Could not retrieve the Unity metadata for {} {} ({}). Using the cached metadata.'.format(entity_type, entity_id, e))
+            return (entry[0], entry[3][1])
+        raise
+
+    if validators.get(key):
+        try:
+            store(site, entity_type, entity_id, metadata, validators[key],
+                  (bool(resolve_context_entity), context_entity), db_path)
+        except Exception as e:
+            log.debug('Could not write the local Unity metadata cache: {}'.format(e))
+
+    return (metadata, context_entity)
+
+def _main(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Inspect or purge the local Unity metadata cache')
+    parser.add_argument('--db', help='Path of the cache database. Defaults to the Shotgun cache location')
+    parser.add_argument('command', choices=['info', 'list', 'purge'])
+    args = parser.parse_args(argv)
+
+    db_path = args.db
+    if not db_path:
+        try:
+            db_path = get_cache_path()
+        except ImportError:
+            # The default location is resolved by Toolkit
+            parser.error('sgtk cannot be imported: pass the path of the cache database with --db, '
+                         'or run this script with the Python of a Toolkit installation')
+    if args.command == 'purge':
+        print('Removed {} entries from {}'.format(purge(db_path), db_path))
+        return 0
+
+    cached_entries = entries(db_path)
+    if args.command == 'info':
+        print('Path: {}'.format(db_path))
+        print('Entries: {} (max {})'.format(len(cached_entries), MAX_ENTRIES))
+        print('Size: {} bytes'.format(os.path.getsize(db_path)))
+    else:
+        for entry in cached_entries:
+            print('{site} {entity_type} {entity_id}: {metadata}'.format(**entry))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(_main(sys.argv[1:]))
@@ -0,0 +1,334 @@
+"""
+Background work for the Shotgun panel running in Unity (unity_actions.py)
+
+The panel calls generate_actions on the Qt UI thread for every listed entity
+and on every selection. Whether a Note has a "Jump to Frame" action depends
+on its metadata (Shotgun queries) and on the loaded project and scenes
+(editor bridge calls), which would freeze the panel. Instead:
+
+- the metadata is fetched from Shotgun by a single background worker thread,
+  in batches: the rows of a listing are resolved with a few queries (see
+  unity_metadata.get_metadata_for_entities) instead of a few per row
+- the project and scene checks, which call the editor, are handed back to
+  the main thread, which stores the outcome (see store_action)
+- the outcomes are cached per entity for ACTION_CACHE_TTL seconds, so that
+  revisiting an entity costs nothing
+- generate_actions returns the base actions right away on a cache miss. When
+  the entity shown in the details area turns out to have the action, it is
+  focused again, so that the panel generates its actions again (see
+  set_details_entity)
+
+Optionally (prefetch_scenes setting), the dependencies of the scenes most
+referenced by the resolved notes are also loaded ahead of the jumps (see
+schedule_prefetch).
+"""
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import sgtk
+
+log = sgtk.LogManager.get_logger(__name__)
+
+ACTION_CACHE_TTL = 300 # seconds
+
+# The worker waits BATCH_DELAY after the first queued entity, for the other
+# rows of the listing to be queued, then resolves at most MAX_BATCH_SIZE
+# entities at a time
+BATCH_DELAY = 0.1 # seconds
+MAX_BATCH_SIZE = 200
+
+# (entity type, entity id) -> (resolution time, action params or None)
+_action_cache = {}
+_action_cache_lock = threading.Lock()
+
+# Key of the entity shown in the details area of the panel
+_details_key = None
+
+# Keys of the entities queued or being resolved
+_pending_keys = set()
+_jobs = queue.Queue()
+_worker = None
+_worker_lock = threading.Lock()
+
+def get_entity_key(entity):
+    return (entity.get('type'), entity.get('id'))
+
+def get_cached_action(entity):
+    """
+    Returns (True, action params or None) if the action of the passed entity
+    was resolved recently, (False, None) otherwise
+    """
+    with _action_cache_lock:
+        cached = _action_cache.get(get_entity_key(entity))
+    if not cached or time.time() - cached[0] > ACTION_CACHE_TTL:
+        return (False, None)
+    params = cached[1]
+    return (True, dict(params) if params else None)
+
+def store_action(key, params):
+    """
+    Stores the outcome of the resolution of the action of the entity with the
+    passed (entity type, entity id) key: its params, or None if it has none
+    """
+    with _action_cache_lock:
+        _action_cache[key] = (time.time(), params)
+        _pending_keys.discard(key)
+
+def set_details_entity(entity):
+    """
+    Records the entity the panel generates the details area actions of
+    """
+    global _details_key
+    _details_key = get_entity_key(entity)
+
+def is_details_entity(key):
+    return key == _details_key
+
+def invalidate_action_cache():
+    with _action_cache_lock:
+        _action_cache.clear()
+
+def _process_jobs(jobs):
+    entities = [entity for (_, entity, _, _) in jobs]
+    (fetch_metadata, on_fetched) = jobs[-1][2:]
+    try:
+        results = fetch_metadata(entities)
+    except Exception as e:
+        log.debug('Could not fetch the metadata of {} entities: {}'.format(len(entities), e))
+        results = {}
+
+    # Entities without metadata have no action: no need for the editor checks
+    fetched = {}
+    for (key, _, _, _) in jobs:
+        metadata = results.get(key)
+        if metadata:
+            fetched[key] = metadata
+        else:
+            store_action(key, None)
+    if not fetched:
+        return
+
+    try:
+        on_fetched(fetched)
+    except Exception as e:
+        log.debug('Unity action callback failed: {}'.format(e))
+        for key in fetched:
+            store_action(key, None)
+
+def _run_worker():
+    while True:
+        jobs = [_jobs.get()]
+        time.sleep(BATCH_DELAY)
+        while len(jobs) < MAX_BATCH_SIZE:
+            try:
+                jobs.append(_jobs.get_nowait())
+            except queue.Empty:
+                break
+        _process_jobs(jobs)
+
+def resolve_action(entity, fetch_metadata, on_fetched):
+    """
+    Queues the resolution of the action of the passed entity. Entities
+    already queued are not queued again
+
+    In the worker thread, fetch_metadata(entities) returns the metadata of the
+    entities keyed by (entity type, entity id), and only queries Shotgun. The
+    entities with metadata are then passed to on_fetched(results), also in
+    the worker thread, which must hand them over to the main thread for the
+    editor checks and call store_action for each of them
+    """
+    global _worker
+    key = get_entity_key(entity)
+    with _action_cache_lock:
+        if key in _pending_keys:
+            return
+        _pending_keys.add(key)
+
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_run_worker, name='Shotgun panel actions')
+            _worker.daemon = True
+            _worker.start()
+
+    _jobs.put((key, entity, fetch_metadata, on_fetched))
+
+################################################################################
+# Scene prefetch
+
+# Time spent loading assets per editor update, so that the editor stays
+# responsive while prefetching
+PREFETCH_SLICE_DURATION = 0.05 # seconds
+
+# Running prefetch, if any
+_prefetch = None
+
+# Scenes which are not prefetched again: fully prefetched, or given up on
+# after exhausting the budget. Scenes interrupted by the user are retried
+_prefetched_scenes = set()
+
+def get_referenced_scenes():
+    """
+    Returns [(scene path, number of notes, action params of one of them)] for
+    the scenes of the recently resolved actions, most referenced first
+    """
+    now = time.time()
+    scenes = {}
+    with _action_cache_lock:
+        for (resolve_time, params) in _action_cache.values():
+            if not params or now - resolve_time > ACTION_CACHE_TTL:
+                continue
+            scene_path = params.get('scene_path')
+            if scene_path:
+                (count, scene_params) = scenes.get(scene_path, (0, params))
+                scenes[scene_path] = (count + 1, scene_params)
+
+    references = [(scene_path, count, params) for (scene_path, (count, params)) in scenes.items()]
+    references.sort(key=lambda reference: (-reference[1], reference[0]))
+    return references
+
+def _get_allocated_memory():
+    from sg_client import GetUnityEngine
+    try:
+        return GetUnityEngine().Profiling.Profiler.GetTotalAllocatedMemoryLong()
+    except Exception as e:
+        log.debug('Could not read the allocated memory, only the prefetch time budget applies: {}'.format(e))
+        return None
+
+def _get_editor_state():
+    """
+    Returns a snapshot of the editor state which changes when the user
+    interacts with the editor (the undo group is incremented on user input)
+    """
+    from sg_client import GetUnityEngine, GetUnityEditor
+    UnityEditor = GetUnityEditor()
+    return (UnityEditor.Undo.GetCurrentGroup(),
+            UnityEditor.Selection.activeInstanceID,
+            UnityEditor.EditorApplication.isPlayingOrWillChangePlaymode,
+            GetUnityEngine().SceneManagement.SceneManager.GetActiveScene().path)
+
+class _ScenePrefetch(object):
+    """
+    Loads the dependencies of scenes in the AssetDatabase, a slice per editor
+    update, until the queue is empty, a budget is exhausted or the user
+    interacts with the editor
+    """
+    def __init__(self, time_budget, memory_budget):
+        self.time_budget = time_budget
+        # bytes
+        self.memory_budget = memory_budget * 1024 * 1024 if memory_budget else None
+        self.scenes = set()
+        self.running = False
+
+        self._guids = []
+        self._time_spent = 0.0
+        self._loaded_count = 0
+        self._start_memory = _get_allocated_memory() if self.memory_budget else None
+        self._editor_state = None
+
+    def add_scene(self, scene_path, params):
+        import unity_scene
+
+        self.scenes.add(scene_path)
+        self._guids += unity_scene.get_dependency_guids(params)
+
+    def start(self):
+        self._editor_state = _get_editor_state()
+        self.running = True
+        self._schedule()
+
+    def stop(self, reason, final=False):
+        """
+        Stops the prefetch. Its scenes are not prefetched again if final
+        """
+        if final:
+            _prefetched_scenes.update(self.scenes)
+        if self.running:
+            self.running = False
+            log.debug('Scene prefetch stopped ({}): {} assets loaded in {:.2f} seconds, {} left'.format(
+                reason, self._loaded_count, self._time_spent, len(self._guids)))
+
+    def _schedule(self):
+        import unity_scene
+        if not unity_scene.schedule_call(self._step):
+            log.warning('Could not schedule the next slice of the scene prefetch on the next editor update')
+            self.stop('could not schedule the next slice')
+
+    def _is_over_budget(self):
+        if self._time_spent >= self.time_budget:
+            return True
+        if self._start_memory is not None:
+            memory = _get_allocated_memory()
+            if memory is not None and memory - self._start_memory >= self.memory_budget:
+                return True
+        return False
+
+    def _step(self):
+        if not self.running:
+            return
+        try:
+            if _get_editor_state() != self._editor_state:
+                self.stop('user interaction')
+                return
+            if self._is_over_budget():
+                self.stop('budget exhausted', final=True)
+                return
+
+            import unity_scene
+            start = time.time()
+            self._loaded_count += unity_scene.load_dependencies(self._guids, PREFETCH_SLICE_DURATION)
+            self._time_spent += time.time() - start
+
+            if not self._guids:
+                self.stop('done', final=True)
+                return
+            # Only the changes made between the slices, by the user, count
+            self._editor_state = _get_editor_state()
+        except Exception as e:
+            self.stop('error: {}'.format(e))
+            return
+        self._schedule()
+
+def schedule_prefetch(max_scenes, time_budget, memory_budget=None):
+    """
+    Prefetches the dependencies of the max_scenes scenes most referenced by
+    the recently resolved actions, except the loaded scenes and the scenes
+    already prefetched (see _prefetched_scenes). A running prefetch is
+    extended with the new scenes, within its budget. Must be called in the
+    editor main thread
+
+    time_budget is in seconds, memory_budget in MB of allocated memory (None
+    for no memory budget)
+    """
+    global _prefetch
+    from sg_client import GetUnityEngine
+    SceneManager = GetUnityEngine().SceneManagement.SceneManager
+
+    prefetch = _prefetch if _prefetch and _prefetch.running else _ScenePrefetch(time_budget, memory_budget)
+
+    added = False
+    for (scene_path, count, params) in get_referenced_scenes()[:max_scenes]:
+        if scene_path in _prefetched_scenes or scene_path in prefetch.scenes:
+            continue
+        scene = SceneManager.GetSceneByPath(scene_path)
+        if scene.IsValid() and scene.isLoaded:
+            continue
+        log.debug('Prefetching {} (referenced by {} notes)'.format(scene_path, count))
+        prefetch.add_scene(scene_path, params)
+        added = True
+
+    if not added or prefetch.running:
+        return
+    _prefetch = prefetch
+    prefetch.start()
+
+def stop_prefetch(reason='stopped'):
+    """
+    Stops the running prefetch, e.g. before jumping to a scene
+    """
+    if _prefetch:
+        _prefetch.stop(reason)
@@ -0,0 +1,356 @@
+"""
+Scene operations shared by the hooks running in the Unity editor: the Shotgun
+panel actions (unity_actions.py) and the tk-unity bootstrap
+(apply_metadata.py)
+"""
+from sg_client import GetUnityEngine, GetUnityEditor
+
+import sgtk
+
+import threading
+import time
+
+log = sgtk.LogManager.get_logger(__name__)
+
+# How a scene which is not loaded yet is opened (scene_open_mode setting of
+# the Shotgun panel):
+# - single: replaces the open scenes
+# - additive: added to the open scenes, and made the active scene
+# - deferred: like single, on the next editor update, so that the click or
+#   the bootstrap returns right away
+SCENE_OPEN_MODES = ['single', 'additive', 'deferred']
+DEFAULT_SCENE_OPEN_MODE = 'single'
+
+# Before a deferred scene open, the scene dependencies are loaded for
+# WARM_SLICE_DURATION per editor update, so that the editor stays responsive,
+# for at most WARM_TIME_BUDGET. The remaining ones are loaded by the scene
+WARM_SLICE_DURATION = 0.05 # seconds
+WARM_TIME_BUDGET = 10 # seconds
+
+# GUIDs of the assets loaded ahead of the scene opens so far
+_loaded_guids = set()
+
+def get_dependency_guids(metadata):
+    """
+    Returns the GUIDs of the assets the metadata scene depends on (metadata
+    1.1 and later) which are not loaded yet, the Timeline asset first. They
+    are loaded before the deferred scene opens (see warm_dependencies), and
+    ahead of the jumps by the scene prefetch of the Shotgun panel (see
+    unity_panel.py)
+    """
+    guids = list(metadata.get('dependencies') or [])
+    timeline = metadata.get('timeline')
+    if timeline:
+        guids = [timeline] + [guid for guid in guids if guid != timeline]
+    return [guid for guid in guids if guid not in _loaded_guids]
+
+def load_dependencies(guids, duration):
+    """
+    Loads the assets of the GUIDs popped from the front of the passed list,
+    for at most duration seconds. Returns the number of loaded assets
+    """
+    AssetDatabase = GetUnityEditor().AssetDatabase
+    start = time.time()
+    loaded_count = 0
+    while guids and time.time() - start < duration:
+        guid = guids.pop(0)
+        if guid in _loaded_guids:
+            continue
+        _loaded_guids.add(guid)
+        path = AssetDatabase.GUIDToAssetPath(guid)
+        if path:
+            AssetDatabase.LoadMainAssetAtPath(path)
+            loaded_count += 1
+    return loaded_count
+
+def schedule_call(function):
+    """
+    Queues the passed function in EditorApplication.delayCall, to be called
+    on the next editor update. Returns False if it could not be queued
+
+    delayCall is a static delegate field, not an event, and it is None when
+    nothing is queued: the callback is wrapped in a CallbackFunction and
+    combined with the queued ones, then the invocation list is checked
+    """
+    try:
+        EditorApplication = GetUnityEditor().EditorApplication
+        CallbackFunction = EditorApplication.CallbackFunction
+        callback = CallbackFunction(function)
+        queued = EditorApplication.delayCall
+        queued_count = _get_callback_count(queued)
+        if queued is None:
+            EditorApplication.delayCall = callback
+        else:
+            EditorApplication.delayCall = CallbackFunction.Combine(queued, callback)
+        if _get_callback_count(EditorApplication.delayCall) != queued_count + 1:
+            raise RuntimeError('EditorApplication.delayCall was not updated')
+    except Exception as e:
+        log.debug('Could not schedule a call on the next editor update: {}'.format(e))
+        return False
+    return True
+
+def _get_callback_count(callbacks):
+    return len(callbacks.GetInvocationList()) if callbacks is not None else 0
+
+def call_later(function):
+    """
+    Calls the passed function on the next editor update (see schedule_call),
+    or right away if it cannot be scheduled
+    """
+    if not schedule_call(function):
+        log.warning('Could not schedule {} on the next editor update, calling it right away'.format(
+            getattr(function, '__name__', function)))
+        function()
+
+class _DependencyWarmer(object):
+    """
+    Loads the dependencies of a scene a slice per editor update, then calls
+    the passed function (see warm_dependencies)
+    """
+    def __init__(self, guids, then, is_cancelled):
+        self.guids = guids
+        self.then = then
+        self.is_cancelled = is_cancelled
+        self.loaded_count = 0
+        self.time_spent = 0.0
+
+    def step(self):
+        try:
+            if self.is_cancelled and self.is_cancelled():
+                self.guids = []
+            else:
+                start = time.time()
+                self.loaded_count += load_dependencies(self.guids, WARM_SLICE_DURATION)
+                self.time_spent += time.time() - start
+        except Exception as e:
+            # Only an optimization: the scene loads its dependencies anyway
+            log.debug('Could not load the scene dependencies: {}'.format(e))
+            self.guids = []
+
+        if self.guids and self.time_spent < WARM_TIME_BUDGET and schedule_call(self.step):
+            return
+        log.debug('Loaded {} scene dependencies in {:.2f} seconds, {} left to the scene'.format(
+            self.loaded_count, self.time_spent, len(self.guids)))
+        call_later(self.then)
+
+def warm_dependencies(metadata, then, is_cancelled=None):
+    """
+    Loads the assets the metadata scene depends on (see get_dependency_guids)
+    on the next editor updates, a slice at a time, then calls the passed
+    function on the next editor update. Stops early once is_cancelled()
+    returns True. Nothing is loaded if the scene is already loaded
+
+    Opening the scene then does not stall on each of its dependencies
+    """
+    guids = get_dependency_guids(metadata)
+    if guids:
+        scene = GetUnityEngine().SceneManagement.SceneManager.GetSceneByPath(metadata.get('scene_path'))
+        if scene.IsValid() and scene.isLoaded:
+            guids = []
+    if not guids:
+        call_later(then)
+        return
+    call_later(_DependencyWarmer(guids, then, is_cancelled).step)
+
+def _has_dirty_scenes(SceneManager):
+    for index in range(SceneManager.sceneCount):
+        if SceneManager.GetSceneAt(index).isDirty:
+            return True
+    return False
+
+def open_scene(scene_path, open_mode=None, on_opened=None, metadata=None):
+    """
+    Makes the scene at the passed path (e.g. "Assets/Scenes/main.unity") the
+    active scene, then calls on_opened
+
+    The scene is not reloaded if it is already loaded. Otherwise it is opened
+    with the passed open mode (see SCENE_OPEN_MODES). In deferred mode, the
+    dependencies listed in the passed metadata are loaded first, on the
+    editor updates before the open (see warm_dependencies). When other scenes
+    have unsaved changes, it is opened additively (and still deferred in
+    deferred mode) instead of prompting the user, so that the changes are
+    neither lost nor blocking
+
+    Returns the result of on_opened (True if there is none), or True if the
+    scene is opened later (deferred mode)
+    """
+    if open_mode and open_mode not in SCENE_OPEN_MODES:
+        log.warning('Unknown scene open mode "{}", expected one of {}'.format(open_mode, ', '.join(SCENE_OPEN_MODES)))
+        open_mode = None
+    open_mode = open_mode or DEFAULT_SCENE_OPEN_MODE
+
+    def opened():
+        return on_opened() if on_opened else True
+
+    SceneManager = GetUnityEngine().SceneManagement.SceneManager
+    active_scene = SceneManager.GetActiveScene()
+    if active_scene.path == scene_path:
+        # Already open: reloading it would only discard the unsaved changes
+        if active_scene.isDirty:
+            log.debug('{} is already open with unsaved changes, not reloading it'.format(scene_path))
+        return opened()
+
+    scene = SceneManager.GetSceneByPath(scene_path)
+    if scene.IsValid() and scene.isLoaded:
+        # Loaded additively
+        SceneManager.SetActiveScene(scene)
+        return opened()
+
+    additive = open_mode == 'additive'
+    if not additive and _has_dirty_scenes(SceneManager):
+        log.info('The open scenes have unsaved changes, opening {} alongside them'.format(scene_path))
+        additive = True
+
+    def load():
+        SceneManagement = GetUnityEditor().SceneManagement
+        if additive:
+            scene = SceneManagement.EditorSceneManager.OpenScene(scene_path, SceneManagement.OpenSceneMode.Additive)
+            SceneManager.SetActiveScene(scene)
+        else:
+            SceneManagement.EditorSceneManager.OpenScene(scene_path)
+        return opened()
+
+    if open_mode == 'deferred':
+        if metadata:
+            warm_dependencies(metadata, load)
+        else:
+            call_later(load)
+        return True
+    return load()
+
+# Main PlayableDirector and timeline fps, keyed by (scene path, main timeline
+# tag). Reviewers jump to many frames of the same scene in a row: resolving
+# the director once saves several bridge calls per jump. The cache is
+# invalidated when the hierarchy changes or another scene becomes active
+_director_cache = {}
+_director_cache_subscribed = None
+_director_cache_lock = threading.Lock()
+
+# Type of the Timeline window, known once it has been opened
+_timeline_window_type = None
+
+def invalidate_director_cache(*args):
+    """
+    Discards the resolved main directors
+
+    Also used as the EditorApplication.hierarchyChanged and
+    EditorSceneManager.activeSceneChangedInEditMode handler, hence the unused
+    arguments
+    """
+    with _director_cache_lock:
+        _director_cache.clear()
+
+def _subscribe_director_cache_invalidation(UnityEditor):
+    """
+    Returns True if the cache is invalidated on hierarchy and scene changes
+    """
+    global _director_cache_subscribed
+    if _director_cache_subscribed is None:
+        try:
+            UnityEditor.EditorApplication.hierarchyChanged += invalidate_director_cache
+            UnityEditor.SceneManagement.EditorSceneManager.activeSceneChangedInEditMode += invalidate_director_cache
+            _director_cache_subscribed = True
+        except Exception as e:
+            log.debug('Could not subscribe to the hierarchy changes, the main director will be resolved on every jump: {}'.format(e))
+            _director_cache_subscribed = False
+    return _director_cache_subscribed
+
+def _get_main_director(scene_path, main_timeline_tag, logger):
+    """
+    Returns (main director, timeline fps, True if it was cached), or None
+    after reporting the error to the passed logger
+    """
+    key = (scene_path, main_timeline_tag)
+    with _director_cache_lock:
+        cached = _director_cache.get(key)
+    if cached:
+        return cached + (True,)
+
+    UnityEditor = GetUnityEditor()
+    UnityEngine = GetUnityEngine()
+
+    # Find the right director
+    main_director = None
+    game_objects = UnityEngine.GameObject.FindGameObjectsWithTag(main_timeline_tag)
+    if game_objects:
+        main_director = game_objects[0].GetComponent(UnityEngine.Playables.PlayableDirector)
+
+    if not main_director:
+        logger.error('Shotgun is unable to jump to frame: please choose a PlayableDirector and tag it with "{}".'.format(main_timeline_tag))
+        return None
+
+    timeline = main_director.playableAsset
+    if not timeline:
+        logger.error('Shotgun is unable to jump to frame: The "{}" PlayableDirector does not have a valid Playable Asset assigned.'.format(game_objects[0].name))
+        return None
+
+    fps = timeline.editorSettings.fps
+    if _subscribe_director_cache_invalidation(UnityEditor):
+        with _director_cache_lock:
+            _director_cache[key] = (main_director, fps)
+    return (main_director, fps, False)
+
+def _show_timeline_window(UnityEditor):
+    """
+    Opens the Timeline window, unless it is already open
+    """
+    global _timeline_window_type
+    if _timeline_window_type is not None:
+        try:
+            if len(GetUnityEngine().Resources.FindObjectsOfTypeAll(_timeline_window_type)):
+                return
+        except Exception as e:
+            log.debug('Could not look for an open Timeline window: {}'.format(e))
+
+    UnityEditor.EditorApplication.ExecuteMenuItem("Window/Sequencing/Timeline")
+
+    # The menu item focuses the window it opens
+    focused_window = UnityEditor.EditorWindow.focusedWindow
+    if focused_window:
+        window_type = focused_window.GetType()
+        if 'Timeline' in window_type.Name:
+            _timeline_window_type = window_type
+
+def jump_to_frame(metadata, main_timeline_tag, logger, open_mode=None):
+    """
+    Opens the metadata scene (see open_scene) and scrubs the main timeline to
+    the metadata frame number. The main timeline is the PlayableDirector on
+    the first game object tagged with main_timeline_tag
+
+    Returns True on success, errors are reported to the passed logger. In
+    deferred open mode, the timeline is scrubbed once the scene is open
+    """
+    frame_number = int(metadata['frame_number'])
+    scene_path = metadata.get('scene_path')
+
+    def scrub():
+        return _scrub_main_timeline(scene_path, main_timeline_tag, frame_number, logger)
+
+    return open_scene(scene_path, open_mode, scrub, metadata)
+
+def _scrub_main_timeline(scene_path, main_timeline_tag, frame_number, logger):
+    UnityEditor = GetUnityEditor()
+
+    # Set the current time
+    _show_timeline_window(UnityEditor)
+
+    while True:
+        resolved = _get_main_director(scene_path, main_timeline_tag, logger)
+        if not resolved:
+            return False
+        (main_director, fps, cached) = resolved
+
+        try:
+            # focus on the PlayableDirector in the Timeline window
+            UnityEditor.Selection.activeObject = main_director
+            main_director.time = frame_number / fps
+        except Exception as e:
+            invalidate_director_cache()
+            if cached:
+                # e.g. the director was destroyed without a hierarchy change
+                # notification: resolve it again
+                continue
+            logger.error('Unable to Jump to Frame: ' + str(e))
+            return False
+
+        return True